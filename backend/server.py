@@ -1,28 +1,159 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Dict, Tuple
+from collections import OrderedDict, deque
+from contextlib import aclosing
 import uuid
+import asyncio
+import hashlib
+import time
+import calendar
+import contextvars
 from datetime import datetime, timezone, timedelta
 import base64
+import json
 import io
-from PIL import Image
+import zlib
+import gzip
+from email.utils import format_datetime, parsedate_to_datetime
+import csv
+import codecs
+import re
+from PIL import Image, ImageOps
 import random
+import numpy as np
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional, the stdlib encoder is the fallback
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional, gzip is the fallback
+    brotli = None
 
 # Import emergent integrations
 from emergentintegrations.llm.chat import LlmChat, UserMessage
+import litellm
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics, exposed on /api/metrics
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', '0') == '1'
+
+metrics_registry = CollectorRegistry()
+HTTP_REQUEST_SECONDS = Histogram(
+    "smartcrop_http_request_seconds", "Request latency by route",
+    ["method", "route", "status"], registry=metrics_registry
+)
+HTTP_IN_FLIGHT = Gauge("smartcrop_http_requests_in_flight", "Requests being handled", registry=metrics_registry)
+MONGO_COMMAND_SECONDS = Histogram(
+    "smartcrop_mongo_command_seconds", "MongoDB command latency",
+    ["command", "collection"], registry=metrics_registry,
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "smartcrop_mongo_command_failures", "MongoDB commands that failed", ["command"], registry=metrics_registry
+)
+LLM_CALL_SECONDS = Histogram(
+    "smartcrop_llm_call_seconds", "LLM call latency, excluding time queued for a slot",
+    ["kind"], registry=metrics_registry,
+    buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+)
+LLM_QUEUE_SECONDS = Histogram(
+    "smartcrop_llm_queue_seconds", "Time spent waiting for an LLM slot",
+    registry=metrics_registry, buckets=(0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+# Per-request dependency time; Motor copies the context into its executor threads
+request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_timings", default=None)
+
+def add_request_timing(name: str, seconds: float):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command by name and collection"""
+
+    def __init__(self):
+        self._collections: Dict[Tuple, str] = {}
+
+    def started(self, event):
+        target = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = target if isinstance(target, str) else ""
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMAND_SECONDS.labels(event.command_name, collection).observe(seconds)
+        add_request_timing("mongo", seconds)
+
+    def failed(self, event):
+        self._collections.pop((event.connection_id, event.request_id), None)
+        MONGO_COMMAND_FAILURES.labels(event.command_name).inc()
+        add_request_timing("mongo", event.duration_micros / 1e6)
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency, optionally reported back in a Server-Timing header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        timings = {}
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+        
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING_HEADER:
+                    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+                    entries.append(f"app;dur={(time.perf_counter() - start) * 1000:.1f}")
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", ", ".join(entries).encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+        
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            # Route templates, not raw paths, keep label cardinality bounded
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], getattr(route, "path", "unmatched"), str(status)
+            ).observe(time.perf_counter() - start)
+            request_timings.reset(token)
+
+mongo_command_timer = MongoCommandTimer()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware so BSON dates come back as UTC datetimes matching the models
+client = AsyncIOMotorClient(
+    mongo_url, tz_aware=True, tzinfo=timezone.utc, event_listeners=[mongo_command_timer]
+)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
@@ -37,11 +168,13 @@ class CropAdviceRequest(BaseModel):
     crop_type: Optional[str] = None
     location: Optional[str] = None
     language: Optional[str] = "English"
+    farmer_id: Optional[str] = None  # keeps a conversation per farmer when set
 
 class CropAdviceResponse(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     query: str
     advice: str
+    farmer_id: Optional[str] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class PestDetectionRequest(BaseModel):
@@ -54,6 +187,19 @@ class PestDetectionResponse(BaseModel):
     recommendations: str
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class PestDetectionBatchRequest(BaseModel):
+    items: List[PestDetectionRequest]
+
+class PestDetectionBatchItem(BaseModel):
+    index: int
+    result: Optional[PestDetectionResponse] = None
+    error: Optional[str] = None
+
+class PestDetectionBatchResponse(BaseModel):
+    results: List[PestDetectionBatchItem]
+    succeeded: int
+    failed: int
+
 class FarmerProfile(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -99,7 +245,7 @@ class MarketAlert(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     farmer_id: str
     crop_name: str
-    alert_type: str  # "price_spike", "high_demand", "best_selling_time"
+    alert_type: str  # "price_spike", "price_drop", "high_demand"
     message: str
     priority: str  # "high", "medium", "low"
     mandi_name: str
@@ -125,16 +271,13 @@ class DemandForecast(BaseModel):
     price_trend: str
     market_factors: List[str]
 
-# Initialize LLM Chat
-def get_llm_chat():
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
-    if not api_key:
-        raise HTTPException(status_code=500, detail="LLM API key not configured")
-    
-    return LlmChat(
-        api_key=api_key,
-        session_id="crop_advisory_session",
-        system_message="""You are an expert agricultural advisor and market analyst specialized in Punjab/Haryana agriculture. 
+LLM_PROVIDER = "openai"
+LLM_MODEL = "gpt-4o-mini"
+# Token streaming calls litellm directly, which does not know how LlmChat routes the emergent key,
+# so it is opt-in and needs an explicit OpenAI-compatible base URL
+LLM_STREAMING = os.environ.get('LLM_STREAMING', '0') == '1'
+LLM_API_BASE = os.environ.get('LLM_API_BASE') or None
+LLM_SYSTEM_MESSAGE = """You are an expert agricultural advisor and market analyst specialized in Punjab/Haryana agriculture. 
         
         Provide practical advice on:
         - Crop planning and calendar optimization
@@ -145,7 +288,387 @@ def get_llm_chat():
         
         Focus on major crops: Rice, Wheat, Corn, Cotton, Sugarcane, Mustard, and regional varieties.
         Always consider local climate, soil conditions, and market dynamics of Punjab/Haryana region."""
-    ).with_model("openai", "gpt-4o-mini")
+
+def get_llm_api_key():
+    api_key = os.environ.get('EMERGENT_LLM_KEY')
+    if not api_key:
+        raise HTTPException(status_code=500, detail="LLM API key not configured")
+    return api_key
+
+# Initialize LLM Chat
+def get_llm_chat(session_id: str):
+    return LlmChat(
+        api_key=get_llm_api_key(),
+        session_id=session_id,
+        system_message=LLM_SYSTEM_MESSAGE
+    ).with_model(LLM_PROVIDER, LLM_MODEL)
+
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '8'))
+LLM_MAX_SESSIONS = int(os.environ.get('LLM_MAX_SESSIONS', '1000'))
+LLM_SESSION_MAX_TURNS = int(os.environ.get('LLM_SESSION_MAX_TURNS', '10'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '64'))  # callers allowed to wait for a slot
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '30'))  # per call, including time queued
+LLM_STREAM_TIMEOUT_SECONDS = float(os.environ.get('LLM_STREAM_TIMEOUT_SECONDS', '120'))  # whole streamed answer
+LLM_BREAKER_FAILURE_RATIO = float(os.environ.get('LLM_BREAKER_FAILURE_RATIO', '0.5'))
+LLM_BREAKER_SLOW_SECONDS = float(os.environ.get('LLM_BREAKER_SLOW_SECONDS', '15'))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', '30'))
+
+class LlmUnavailable(Exception):
+    """The LLM call was shed (circuit open, queue full or deadline exceeded) or the provider failed"""
+
+class CircuitBreaker:
+    """Trips when too many recent calls failed or ran slow, then lets one probe through after a cooldown.
+
+    Slow successes count against the provider like failures, since a provider
+    that answers in a minute hurts as much as one that errors.
+    """
+
+    WINDOW = 20
+    MIN_CALLS = 10
+
+    def __init__(self, failure_ratio: float, slow_seconds: float, cooldown_seconds: float):
+        self.failure_ratio = failure_ratio
+        self.slow_seconds = slow_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.state = "closed"  # "closed", "open", "half_open"
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+        self.generation = 0  # bumped on every state change
+        self._outcomes = deque(maxlen=self.WINDOW)  # True for a failed or slow call
+
+    def allow(self) -> Optional[int]:
+        """Admit a call, returning the generation its outcome is recorded against, or None to shed it"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown_seconds:
+                return None
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self.probing:
+                return None
+            self.probing = True
+        return self.generation
+
+    def record(self, generation: int, seconds: float, ok: bool):
+        if generation != self.generation:
+            # Admitted before the last state change, so it says nothing about the provider now
+            return
+        bad = not ok or seconds >= self.slow_seconds
+        if self.state == "half_open":
+            self.probing = False
+            if bad:
+                self._open()
+            else:
+                self._transition("closed")
+            return
+        self._outcomes.append(bad)
+        # Only a bad call can trip the breaker, never a success arriving while the provider recovers
+        if bad and len(self._outcomes) >= self.MIN_CALLS and sum(self._outcomes) / len(self._outcomes) >= self.failure_ratio:
+            self._open()
+
+    def abandon(self, generation: int):
+        """A call that was allowed never reached the provider; free the probe slot"""
+        if self.state == "half_open" and generation == self.generation:
+            self.probing = False
+
+    def _transition(self, state: str):
+        self.state = state
+        self.generation += 1
+        self.probing = False
+        self._outcomes.clear()
+
+    def _open(self):
+        self._transition("open")
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        logger.warning("LLM circuit breaker opened; serving fallback answers")
+
+class LlmSession:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.chat = None
+        self.turns = 0
+        self.lock = asyncio.Lock()
+
+class LlmClientPool:
+    """Admission-controlled access to LLM clients with bounded per-farmer sessions.
+
+    At most size calls run at once and at most max_queue more wait for a slot;
+    every call has a deadline, and a circuit breaker stops calls while the
+    provider is failing. Shed calls raise LlmUnavailable straight away, and
+    failed calls raise it too, so callers have a single error to fall back on.
+    Streamed calls go through the same slots, queue and breaker.
+
+    Calls without a session get a fresh per-request session. Farmer sessions live
+    in an LRU of at most max_sessions entries, and each one is restarted after
+    max_turns exchanges so its history (and prompt size) stays bounded.
+    """
+
+    def __init__(self, size: int, max_sessions: int, max_turns: int, max_queue: int,
+                 timeout: float, breaker: CircuitBreaker, stream_timeout: Optional[float] = None):
+        self.size = size
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.stream_timeout = stream_timeout or timeout
+        self.breaker = breaker
+        self._slots = None
+        self._sessions = OrderedDict()  # session_id -> LlmSession
+        self.in_flight = 0
+        self.waiting = 0
+        self.session_resets = 0
+        self.shed = {"circuit_open": 0, "queue_full": 0, "deadline": 0}
+
+    def start(self):
+        # Created here rather than in __init__ so the semaphore belongs to the server's event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+
+    def _session(self, session_id: str) -> LlmSession:
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = LlmSession(session_id)
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _admit(self) -> int:
+        self.start()
+        generation = self.breaker.allow()
+        if generation is None:
+            self.shed["circuit_open"] += 1
+            raise LlmUnavailable("LLM circuit breaker is open")
+        if self.in_flight + self.waiting >= self.size + self.max_queue:
+            self.breaker.abandon(generation)
+            self.shed["queue_full"] += 1
+            raise LlmUnavailable("LLM queue is full")
+        # Counted as waiting from admission, so a burst cannot all pass the check before any of it queues
+        self.waiting += 1
+        return generation
+
+    async def send(self, prompt: str, session_id: Optional[str] = None) -> str:
+        generation = self._admit()
+        call = {"started_at": None}
+        try:
+            result = await asyncio.wait_for(self._send(prompt, session_id, call), self.timeout)
+        except asyncio.TimeoutError:
+            self.shed["deadline"] += 1
+            if call["started_at"] is None:
+                self.breaker.abandon(generation)
+            else:
+                self.breaker.record(generation, time.perf_counter() - call["started_at"], ok=False)
+            raise LlmUnavailable(f"LLM call exceeded the {self.timeout:g}s deadline")
+        except asyncio.CancelledError:
+            self.breaker.abandon(generation)
+            raise
+        except Exception as e:
+            started_at = call["started_at"]
+            self.breaker.record(generation, time.perf_counter() - started_at if started_at else 0.0, ok=False)
+            raise LlmUnavailable(f"LLM call failed: {str(e)}") from e
+        finally:
+            if call["started_at"] is None:
+                self.waiting -= 1
+        self.breaker.record(generation, time.perf_counter() - call["started_at"], ok=True)
+        return result
+
+    async def _acquire(self, call: Dict):
+        queued_at = time.perf_counter()
+        await self._slots.acquire()
+        self.waiting -= 1
+        LLM_QUEUE_SECONDS.observe(time.perf_counter() - queued_at)
+        self.in_flight += 1
+        call["started_at"] = time.perf_counter()
+
+    def _release(self, call: Dict, kind: str):
+        self.in_flight -= 1
+        self._slots.release()
+        seconds = time.perf_counter() - call["started_at"]
+        LLM_CALL_SECONDS.labels(kind).observe(seconds)
+        add_request_timing("llm", seconds)
+
+    async def _send(self, prompt: str, session_id: Optional[str], call: Dict) -> str:
+        if session_id is None:
+            await self._acquire(call)
+            try:
+                llm_chat = get_llm_chat(f"request-{uuid.uuid4()}")
+                return await llm_chat.send_message(UserMessage(text=prompt))
+            finally:
+                self._release(call, "stateless")
+        
+        session = self._session(session_id)
+        # Queue on the farmer's own session first, so turns waiting on each other never hold a slot idle
+        async with session.lock:
+            await self._acquire(call)
+            try:
+                if session.chat is None or session.turns >= self.max_turns:
+                    if session.chat is not None:
+                        self.session_resets += 1
+                    session.chat = get_llm_chat(session_id)
+                    session.turns = 0
+                session.turns += 1
+                return await session.chat.send_message(UserMessage(text=prompt))
+            finally:
+                self._release(call, "session")
+
+    async def stream(self, prompt: str):
+        """Yield the chunks of one stateless streamed call.
+
+        The first chunk must arrive within timeout of admission (queueing included) and the
+        whole answer within stream_timeout. The breaker judges the provider by time to first
+        chunk. The slot is released however the stream ends, including a client disconnect.
+        """
+        generation = self._admit()
+        call = {"started_at": None}
+        admitted_at = time.perf_counter()
+        first_chunk_at = None
+        ok = None  # stays None when the caller goes away before the provider answered
+        
+        def remaining() -> float:
+            limit = self.timeout if first_chunk_at is None else self.stream_timeout
+            return admitted_at + limit - time.perf_counter()
+        
+        try:
+            await asyncio.wait_for(self._acquire(call), remaining())
+            response = await asyncio.wait_for(open_llm_stream(prompt), remaining())
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), remaining())
+                except StopAsyncIteration:
+                    break
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                if text:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                    yield text
+            ok = True
+        except asyncio.TimeoutError:
+            ok = False
+            if first_chunk_at is None:
+                self.shed["deadline"] += 1
+                raise LlmUnavailable(f"LLM stream did not start within the {self.timeout:g}s deadline")
+            raise
+        except Exception:
+            ok = False
+            raise
+        finally:
+            if call["started_at"] is None:
+                self.waiting -= 1
+            else:
+                self._release(call, "stream")
+            if ok is None and first_chunk_at is None:
+                self.breaker.abandon(generation)
+            else:
+                started_at = call["started_at"] or admitted_at
+                self.breaker.record(generation, (first_chunk_at or time.perf_counter()) - started_at, ok=ok is not False)
+
+    def stats(self) -> Dict:
+        return {
+            "size": self.size,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "queue_limit": self.max_queue,
+            "sessions": len(self._sessions),
+            "session_resets": self.session_resets,
+            "breaker_state": self.breaker.state,
+            "breaker_open": int(self.breaker.state == "open"),
+            "breaker_trips": self.breaker.trips,
+            **{f"shed_{reason}": count for reason, count in self.shed.items()},
+        }
+
+llm_pool = LlmClientPool(
+    LLM_MAX_CONCURRENCY, LLM_MAX_SESSIONS, LLM_SESSION_MAX_TURNS, LLM_MAX_QUEUE, LLM_TIMEOUT_SECONDS,
+    CircuitBreaker(LLM_BREAKER_FAILURE_RATIO, LLM_BREAKER_SLOW_SECONDS, LLM_BREAKER_COOLDOWN_SECONDS),
+    LLM_STREAM_TIMEOUT_SECONDS
+)
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key onto one shared in-flight task"""
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def _forget(self, key: str, task: asyncio.Future):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Mark the outcome as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, factory):
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        # shield() keeps one disconnecting client from cancelling the call for everyone else
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
+
+llm_single_flight = SingleFlight()
+
+async def ask_llm(prompt: str, session_id: Optional[str] = None) -> str:
+    """Send a prompt to the LLM, sharing one in-flight call between identical stateless prompts"""
+    if session_id is not None:
+        # Answers in a conversation depend on its history, so they are never shared
+        return await llm_pool.send(prompt, session_id)
+
+    async def send():
+        return await llm_pool.send(prompt)
+
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return await llm_single_flight.do(key, send)
+
+async def open_llm_stream(prompt: str):
+    return await litellm.acompletion(
+        model=f"{LLM_PROVIDER}/{LLM_MODEL}",
+        api_key=get_llm_api_key(),
+        api_base=LLM_API_BASE,
+        messages=[
+            {"role": "system", "content": LLM_SYSTEM_MESSAGE},
+            {"role": "user", "content": prompt},
+        ],
+        stream=True
+    )
+
+async def stream_llm(prompt: str):
+    """Yield LLM output chunks as they arrive, falling back to a single chunk if streaming is unavailable"""
+    if not LLM_STREAMING:
+        yield await ask_llm(prompt)
+        return
+    started = False
+    try:
+        # aclosing() hands the slot back as soon as the client goes away, not when the generator is collected
+        async with aclosing(llm_pool.stream(prompt)) as chunks:
+            async for chunk in chunks:
+                started = True
+                yield chunk
+    except LlmUnavailable:
+        raise
+    except Exception as e:
+        if started:
+            raise
+        logger.warning(f"LLM streaming unavailable, falling back to a full response: {str(e)}")
+        yield await ask_llm(prompt)
+
+def sse_event(event: str, data: Dict, event_id: Optional[str] = None) -> str:
+    """Format one server-sent event"""
+    id_line = f"id: {event_id}\n" if event_id else ""
+    return f"{id_line}event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
 
 # Simulated data for demo
 PUNJAB_CROPS_DATA = {
@@ -198,185 +721,2381 @@ PUNJAB_MANDIS = [
     "Bathinda Mandi", "Mohali Mandi", "Ferozepur Mandi", "Gurdaspur Mandi"
 ]
 
-def generate_market_prices():
-    """Generate realistic market prices for demo"""
-    prices = []
-    for crop, data in PUNJAB_CROPS_DATA.items():
-        for mandi in PUNJAB_MANDIS[:4]:  # Use top 4 mandis
-            # Add some realistic price variation
-            price_variation = random.uniform(0.85, 1.15)
-            current_price = data["base_price"] * price_variation
-            
-            trend = random.choice(["up", "down", "stable"])
-            demand = random.choice(["high", "medium", "low"])
-            
-            prices.append(MarketPrice(
-                crop_name=crop,
-                mandi_name=mandi,
-                location=mandi.split()[0],
-                current_price=round(current_price, 2),
-                trend=trend,
-                demand_level=demand,
-                quality_grade=random.choice(["A", "B", "C"])
-            ))
-    return prices
+def month_range(months: List[int]) -> str:
+    return f"{calendar.month_abbr[months[0]]}-{calendar.month_abbr[months[-1]]}"
 
-def calculate_optimal_calendar(crop_name: str, location: str):
-    """Calculate optimal sowing and harvesting dates"""
-    if crop_name not in PUNJAB_CROPS_DATA:
+# Templated answers served while the LLM is unavailable
+FALLBACK_NOTICE = "Our AI advisor is busy right now, so this is standard guidance. Please ask again in a few minutes for advice specific to your question."
+
+def crop_guidance(crop: str) -> str:
+    data = PUNJAB_CROPS_DATA[crop]
+    return (
+        f"{crop}: sow {month_range(data['sowing_months'])}, harvest {month_range(data['harvest_months'])} "
+        f"(about {data['growing_days']} days). Typical yield {data['avg_yield_per_acre']} quintals/acre; "
+        f"reference price ₹{data['base_price']}/quintal - check today's mandi rates before selling."
+    )
+
+def fallback_crop_advice(crop_type: Optional[str], location: Optional[str] = None) -> str:
+    crop = canonical_crop(crop_type)
+    if crop in PUNJAB_CROPS_DATA:
+        lines = [crop_guidance(crop)]
+    else:
+        month = datetime.now(timezone.utc).month
+        in_season = [name for name, data in PUNJAB_CROPS_DATA.items() if month in data["sowing_months"]]
+        lines = [crop_guidance(name) for name in in_season or PUNJAB_CROPS_DATA]
+    region = location or "Punjab/Haryana"
+    return f"{FALLBACK_NOTICE}\n\nFor {region}:\n" + "\n".join(f"- {line}" for line in lines)
+
+def fallback_pest_advice(crop_type: Optional[str]) -> str:
+    crop = canonical_crop(crop_type)
+    details = f"\n- {crop_guidance(crop)}" if crop in PUNJAB_CROPS_DATA else ""
+    return (
+        f"{FALLBACK_NOTICE}\n"
+        f"- Isolate affected {crop or 'crop'} plants and remove badly damaged leaves.\n"
+        "- Avoid spraying until the pest is identified; unnecessary sprays harm beneficial insects.\n"
+        "- Take the photo and a sample to your local Krishi Vigyan Kendra or agriculture extension officer."
+        f"{details}"
+    )
+
+def fallback_recommendation_analysis(farmer: Dict) -> str:
+    crops = [crop for crop in map(canonical_crop, farmer.get("primary_crops", [])) if crop in PUNJAB_CROPS_DATA]
+    lines = [crop_guidance(crop) for crop in crops or PUNJAB_CROPS_DATA]
+    return f"{FALLBACK_NOTICE}\n" + "\n".join(f"- {line}" for line in lines)
+
+# Response cache for crop advice
+ADVICE_CACHE_MAX_ENTRIES = int(os.environ.get('ADVICE_CACHE_MAX_ENTRIES', '5000'))
+ADVICE_CACHE_TTL_SECONDS = int(os.environ.get('ADVICE_CACHE_TTL_SECONDS', str(6 * 60 * 60)))
+
+def normalize_text(value: Optional[str]) -> str:
+    """Lowercase and collapse whitespace"""
+    return " ".join((value or "").lower().split())
+
+def canonical_crop(crop_type: Optional[str]) -> str:
+    """Map a free-text crop name onto PUNJAB_CROPS_DATA keys where possible"""
+    normalized = normalize_text(crop_type)
+    for crop in PUNJAB_CROPS_DATA:
+        if crop.lower() == normalized:
+            return crop
+    return normalized
+
+def canonical_crops(crops: List[str]) -> List[str]:
+    """Known crops under their PUNJAB_CROPS_DATA name, any other crop with its whitespace tidied"""
+    tidied = []
+    for crop in crops:
+        canonical = canonical_crop(crop)
+        tidied.append(canonical if canonical in PUNJAB_CROPS_DATA else " ".join(crop.split()))
+    return [crop for crop in tidied if crop]
+
+def canonical_location(location: Optional[str]) -> str:
+    """Map a free-text location onto the city of a known mandi where possible"""
+    normalized = normalize_text(location)
+    tokens = normalized.replace(",", " ").split()
+    for mandi in PUNJAB_MANDIS:
+        city = mandi.split()[0].lower()
+        if normalized == mandi.lower() or city in tokens:
+            return mandi.split()[0]
+    return normalized
+
+def advice_cache_key(request: CropAdviceRequest) -> str:
+    """Build a stable cache key from a normalized CropAdviceRequest"""
+    parts = [
+        normalize_text(request.query),
+        canonical_crop(request.crop_type),
+        canonical_location(request.location),
+        normalize_text(request.language) or "english",
+    ]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+class AdviceCache:
+    """Bounded LRU cache with TTL, backed by a Mongo collection so entries survive restarts"""
+
+    def __init__(self, collection, max_entries: int, ttl_seconds: int):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at monotonic, advice)
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.llm_seconds = 0.0
+        self.llm_calls = 0
+
+    def _remember(self, key: str, advice: str, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, advice)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry:
+            expires_at, advice = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return advice
+            del self._entries[key]
+
+        try:
+            now = datetime.now(timezone.utc)
+            doc = await self.collection.find_one(
+                {"key": key, "expires_at": {"$gt": now}}, {"_id": 0, "advice": 1, "expires_at": 1}
+            )
+        except Exception as e:
+            logger.warning(f"Advice cache lookup failed: {str(e)}")
+            doc = None
+
+        if doc:
+            expires_at = doc["expires_at"]
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            self._remember(key, doc["advice"], (expires_at - now).total_seconds())
+            self.hits += 1
+            self.persistent_hits += 1
+            return doc["advice"]
+
+        self.misses += 1
         return None
-    
-    crop_data = PUNJAB_CROPS_DATA[crop_name]
-    current_date = datetime.now(timezone.utc)
-    
-    # Find next optimal sowing date
-    sowing_months = crop_data["sowing_months"]
-    for month in sowing_months:
-        sowing_date = current_date.replace(month=month, day=15)
-        if sowing_date < current_date:
-            sowing_date = sowing_date.replace(year=current_date.year + 1)
-        
-        # Calculate harvest date
-        harvest_date = sowing_date + timedelta(days=crop_data["growing_days"])
-        
+
+    async def set(self, key: str, advice: str, llm_seconds: float = 0.0):
+        self._remember(key, advice, self.ttl_seconds)
+        self.llm_seconds += llm_seconds
+        self.llm_calls += 1
+        try:
+            await self.collection.update_one(
+                {"key": key},
+                {"$set": {
+                    "key": key,
+                    "advice": advice,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds),
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Advice cache write failed: {str(e)}")
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        avg_llm_seconds = self.llm_seconds / self.llm_calls if self.llm_calls else 0.0
         return {
-            "sowing_date": sowing_date,
-            "harvest_date": harvest_date,
-            "expected_yield": crop_data["avg_yield_per_acre"],
-            "estimated_price": crop_data["base_price"] * random.uniform(0.95, 1.25)
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "avg_llm_seconds": round(avg_llm_seconds, 3),
+            "estimated_llm_seconds_saved": round(self.hits * avg_llm_seconds, 3),
         }
 
-@api_router.get("/")
-async def root():
-    return {"message": "Smart Crop Advisory System API"}
+advice_cache = AdviceCache(db.advice_cache, ADVICE_CACHE_MAX_ENTRIES, ADVICE_CACHE_TTL_SECONDS)
 
-@api_router.post("/crop-advice", response_model=CropAdviceResponse)
-async def get_crop_advice(request: CropAdviceRequest):
+MARKET_PRICE_REFRESH_SECONDS = int(os.environ.get('MARKET_PRICE_REFRESH_SECONDS', '900'))
+MARKET_TREND_WINDOW = int(os.environ.get('MARKET_TREND_WINDOW', '96'))  # ticks, one day at the default refresh
+MARKET_HISTORY_RETENTION_DAYS = int(os.environ.get('MARKET_HISTORY_RETENTION_DAYS', '400'))
+MARKET_SIMULATION_SEED = os.environ.get('MARKET_SIMULATION_SEED')
+MARKET_PRICE_TICKS = "market_price_ticks"
+MARKET_PRICE_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "smartcrop/market-prices")
+
+def market_price_id(crop_name: str, mandi_name: str) -> str:
+    """The same id for a (crop, mandi) row across refreshes and restarts, so clients can upsert by it"""
+    return str(uuid.uuid5(MARKET_PRICE_ID_NAMESPACE, f"{crop_name}|{mandi_name}"))
+
+class MarketPriceEngine:
+    """Simulates prices for every crop x mandi pair at once and derives trend and demand from the series.
+
+    Log prices mean-revert towards each crop's base price, adjusted by a fixed
+    per-mandi premium and a post-harvest supply dip, with daily volatility
+    scaled to the refresh interval.
+    """
+
+    DAILY_VOLATILITY = 0.02
+    DAILY_REVERSION = 0.1
+    HARVEST_DISCOUNT = 0.06
+    TREND_THRESHOLD = 0.01  # relative move across the trend window
+    DEMAND_THRESHOLD = 0.03  # distance from the long-run level
+
+    def __init__(self, crops: Dict, mandis: List[str], tick_seconds: int, window: int, seed: Optional[str] = None):
+        self.crops = list(crops)
+        self.mandis = list(mandis)
+        self.tick_days = tick_seconds / 86400
+        self.rng = np.random.default_rng(int(seed) if seed else None)
+        self.base_prices = np.array([crops[crop]["base_price"] for crop in self.crops], dtype=float)[:, None]
+        self.harvest_months = [set(crops[crop]["harvest_months"]) for crop in self.crops]
+        # Fixed per-series characteristics
+        self.mandi_premium = self.rng.uniform(-0.05, 0.05, size=(1, len(self.mandis)))
+        self.quality_grades = self.rng.choice(np.array(["A", "B", "C"]), size=(len(self.crops), len(self.mandis)))
+        self.history = deque(maxlen=window)  # (timestamp, prices array of shape crops x mandis)
+
+    def long_run_level(self, when: datetime) -> np.ndarray:
+        harvest = np.array([when.month in months for months in self.harvest_months], dtype=float)[:, None]
+        return self.base_prices * (1 + self.mandi_premium) * (1 - self.HARVEST_DISCOUNT * harvest)
+
+    def step(self, when: datetime) -> np.ndarray:
+        target = np.log(self.long_run_level(when))
+        if self.history:
+            log_prices = np.log(self.history[-1][1])
+        else:
+            log_prices = target + self.rng.normal(0, self.DAILY_VOLATILITY, size=target.shape)
+        shock = self.rng.normal(0, self.DAILY_VOLATILITY * np.sqrt(self.tick_days), size=target.shape)
+        log_prices = log_prices + self.DAILY_REVERSION * self.tick_days * (target - log_prices) + shock
+        prices = np.round(np.exp(log_prices), 2)
+        self.history.append((when, prices))
+        return prices
+
+    def warm_up(self, until: datetime) -> List[Tuple[datetime, np.ndarray]]:
+        """Simulate a full trend window of back-dated ticks when there is no stored history"""
+        tick = timedelta(days=self.tick_days)
+        start = until - tick * (self.history.maxlen - 1)
+        return [(start + tick * index, self.step(start + tick * index)) for index in range(self.history.maxlen)]
+
+    def load(self, docs: List[Dict]):
+        """Rebuild the trend window from stored ticks, forward-filling any missing series"""
+        series = {(crop, mandi): (i, j) for i, crop in enumerate(self.crops) for j, mandi in enumerate(self.mandis)}
+        by_time = OrderedDict()
+        for doc in docs:
+            position = series.get((doc["meta"]["crop_name"], doc["meta"]["mandi_name"]))
+            if position is None:
+                continue
+            prices = by_time.setdefault(doc["timestamp"], np.full((len(self.crops), len(self.mandis)), np.nan))
+            prices[position] = doc["price"]
+        self.history.clear()
+        previous = None
+        for timestamp, prices in by_time.items():
+            if previous is not None:
+                prices = np.where(np.isnan(prices), previous, prices)
+            if not np.isnan(prices).any():
+                self.history.append((timestamp, prices))
+            previous = prices
+
+    def trends(self) -> np.ndarray:
+        """Least-squares slope of log price across the window, as a relative move over the whole window"""
+        if len(self.history) < 2:
+            return np.zeros(self.base_prices.shape[:1] + (len(self.mandis),))
+        series = np.log(np.stack([prices for _, prices in self.history], axis=-1))
+        ticks = np.arange(series.shape[-1], dtype=float)
+        ticks -= ticks.mean()
+        slope = (series * ticks).sum(axis=-1) / (ticks ** 2).sum()
+        return slope * (series.shape[-1] - 1)
+
+    def market_prices(self) -> List[MarketPrice]:
+        when, prices = self.history[-1]
+        moves = self.trends()
+        trend = np.where(moves > self.TREND_THRESHOLD, "up", np.where(moves < -self.TREND_THRESHOLD, "down", "stable"))
+        # Prices running above their long-run level signal buyers competing for supply
+        pressure = prices / self.long_run_level(when) - 1
+        demand = np.where(pressure > self.DEMAND_THRESHOLD, "high",
+                          np.where(pressure < -self.DEMAND_THRESHOLD, "low", "medium"))
+        return [
+            MarketPrice(
+                id=market_price_id(crop, mandi),
+                crop_name=crop,
+                mandi_name=mandi,
+                location=mandi.split()[0],
+                current_price=float(prices[i, j]),
+                trend=str(trend[i, j]),
+                demand_level=str(demand[i, j]),
+                quality_grade=str(self.quality_grades[i, j]),
+                last_updated=when
+            )
+            for i, crop in enumerate(self.crops)
+            for j, mandi in enumerate(self.mandis)
+        ]
+
+    def tick_documents(self, when: datetime, prices: np.ndarray) -> List[Dict]:
+        return [
+            {"timestamp": when, "meta": {"crop_name": crop, "mandi_name": mandi}, "price": float(prices[i, j])}
+            for i, crop in enumerate(self.crops)
+            for j, mandi in enumerate(self.mandis)
+        ]
+
+market_engine = MarketPriceEngine(
+    PUNJAB_CROPS_DATA, PUNJAB_MANDIS, MARKET_PRICE_REFRESH_SECONDS, MARKET_TREND_WINDOW, MARKET_SIMULATION_SEED
+)
+
+MARKET_SNAPSHOT_MAX_ENCODED = 256  # filter combinations kept encoded per snapshot
+
+class MarketPriceSnapshot:
+    """Immutable set of market prices served to readers until the next refresh"""
+
+    def __init__(self, prices: Tuple[MarketPrice, ...], version: int):
+        self.prices = prices
+        self.version = version
+        self.updated_at = datetime.now(timezone.utc)
+        self._encoded: Dict[Tuple[Optional[str], Optional[str]], "EncodedJson"] = {}
+
+    def filter(self, crop: Optional[str] = None, mandi: Optional[str] = None) -> List[MarketPrice]:
+        crop_name = canonical_crop(crop) if crop else None
+        mandi_location = canonical_location(mandi) if mandi else None
+        return [
+            price for price in self.prices
+            if (crop_name is None or price.crop_name == crop_name)
+            and (mandi_location is None or price.location == mandi_location)
+        ]
+
+    def encoded(self, crop: Optional[str] = None, mandi: Optional[str] = None) -> "EncodedJson":
+        """Filtered prices as JSON, encoded once per filter for the life of the snapshot"""
+        key = (canonical_crop(crop) if crop else None, canonical_location(mandi) if mandi else None)
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            encoded = EncodedJson([price.dict() for price in self.filter(crop, mandi)], self.updated_at)
+            if len(self._encoded) < MARKET_SNAPSHOT_MAX_ENCODED:
+                self._encoded[key] = encoded
+        return encoded
+
+market_snapshot: Optional[MarketPriceSnapshot] = None
+market_refresh_lock = asyncio.Lock()
+
+async def ensure_price_history_collection():
+    """Create the time-series collection for price ticks if it does not exist yet"""
+    if MARKET_PRICE_TICKS in await db.list_collection_names():
+        return
     try:
-        llm_chat = get_llm_chat()
-        
-        # Construct detailed query
-        enhanced_query = f"""
-        Farmer Question: {request.query}
-        Crop Type: {request.crop_type or 'Not specified'}
-        Location: {request.location or 'Not specified'}
-        Language: {request.language}
-        
-        Please provide specific, actionable advice for this farmer's situation considering Punjab/Haryana agricultural conditions.
-        """
-        
-        user_message = UserMessage(text=enhanced_query)
-        advice = await llm_chat.send_message(user_message)
-        
-        # Save to database
-        advice_obj = CropAdviceResponse(
-            query=request.query,
-            advice=advice
+        await db.create_collection(
+            MARKET_PRICE_TICKS,
+            timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "minutes"},
+            expireAfterSeconds=MARKET_HISTORY_RETENTION_DAYS * 86400
         )
-        
-        advice_dict = advice_obj.dict()
-        advice_dict['timestamp'] = advice_dict['timestamp'].isoformat()
-        await db.crop_advice.insert_one(advice_dict)
-        
-        return advice_obj
-        
-    except Exception as e:
-        logger.error(f"Error getting crop advice: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to get crop advice: {str(e)}")
+    except CollectionInvalid:
+        pass  # created concurrently by another worker
 
-@api_router.post("/pest-detection", response_model=PestDetectionResponse)
-async def detect_pest(request: PestDetectionRequest):
-    try:
-        llm_chat = get_llm_chat()
-        
-        analysis_query = f"""
-        A farmer has uploaded an image of their {request.crop_type or 'crop'} that they suspect has pest or disease issues.
-        
-        Based on common pest and disease patterns for {request.crop_type or 'crops'} in Punjab/Haryana region, provide:
-        1. Likely pest/disease identification
-        2. Immediate treatment recommendations
-        3. Prevention strategies
-        4. When to seek professional help
+async def save_market_prices(market_prices: List[MarketPrice], ticks: List[Dict]):
+    """Append ticks to the price history and upsert the latest prices, one bulk call each"""
+    if ticks:
+        await db[MARKET_PRICE_TICKS].insert_many(ticks, ordered=False)
+    operations = []
+    for price in market_prices:
+        price_dict = price.dict()
+        operations.append(UpdateOne(
+            {"crop_name": price.crop_name, "mandi_name": price.mandi_name},
+            {"$set": price_dict},
+            upsert=True
+        ))
+    if operations:
+        await db.market_prices.bulk_write(operations, ordered=False)
+
+def publish_market_snapshot(market_prices: List[MarketPrice]) -> MarketPriceSnapshot:
+    global market_snapshot
+    version = market_snapshot.version + 1 if market_snapshot else 1
+    market_snapshot = MarketPriceSnapshot(tuple(market_prices), version)
+    return market_snapshot
+
+async def refresh_market_prices() -> MarketPriceSnapshot:
+    """Advance every price series by one tick, persist it, then swap in the new snapshot"""
+    async with market_refresh_lock:
+        now = datetime.now(timezone.utc)
+        prices = market_engine.step(now)
+        market_prices = market_engine.market_prices()
+        await save_market_prices(market_prices, market_engine.tick_documents(now, prices))
+        return publish_market_snapshot(market_prices)
+
+async def load_market_snapshot() -> MarketPriceSnapshot:
+    """Resume the price series from stored ticks after a restart, simulating a history only if none exists"""
+    async with market_refresh_lock:
+        if market_snapshot is None:
+            now = datetime.now(timezone.utc)
+            since = now - timedelta(seconds=MARKET_PRICE_REFRESH_SECONDS * (MARKET_TREND_WINDOW + 1))
+            tick_docs = await db[MARKET_PRICE_TICKS].find(
+                {"timestamp": {"$gte": since}}, {"_id": 0}
+            ).sort("timestamp", ASCENDING).to_list(None)
+            market_engine.load(tick_docs)
+            
+            ticks = []
+            if not market_engine.history:
+                for when, prices in market_engine.warm_up(now):
+                    ticks.extend(market_engine.tick_documents(when, prices))
+            market_prices = market_engine.market_prices()
+            if ticks:
+                await save_market_prices(market_prices, ticks)
+            publish_market_snapshot(market_prices)
+    return market_snapshot
+
+async def get_market_snapshot() -> MarketPriceSnapshot:
+    return market_snapshot or await load_market_snapshot()
+
+async def market_price_refresher():
+    """Periodically refresh market prices in the background"""
+    while True:
+        await asyncio.sleep(MARKET_PRICE_REFRESH_SECONDS)
+        try:
+            snapshot = await refresh_market_prices()
+        except Exception as e:
+            logger.error(f"Error refreshing market prices: {str(e)}")
+            continue
+        try:
+            await alert_engine.evaluate(snapshot)
+        except Exception as e:
+            logger.error(f"Error evaluating market alerts: {str(e)}")
+
+# Market alerts
+ALERT_SPIKE_THRESHOLD = float(os.environ.get('ALERT_SPIKE_THRESHOLD', '0.08'))  # relative to base_price
+ALERT_DROP_THRESHOLD = float(os.environ.get('ALERT_DROP_THRESHOLD', '0.08'))
+ALERT_INSERT_BATCH_SIZE = 1000
+ALERT_SUBSCRIBER_QUEUE_SIZE = 100
+
+class AlertBroker:
+    """Fans new alerts out to the live subscriptions of each farmer in this process"""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, set] = {}
+        self.dropped = 0
+
+    def subscribe(self, farmer_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(farmer_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, farmer_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(farmer_id)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[farmer_id]
+
+    def publish(self, alerts: List[MarketAlert]):
+        for alert in alerts:
+            for queue in self.subscribers.get(alert.farmer_id, ()):
+                if queue.full():
+                    # A stalled client loses its oldest alert; it can catch up with ?since= on reconnect
+                    queue.get_nowait()
+                    self.dropped += 1
+                queue.put_nowait(alert)
+
+    def stats(self) -> Dict:
+        return {
+            "farmers": len(self.subscribers),
+            "subscriptions": sum(len(queues) for queues in self.subscribers.values()),
+            "dropped": self.dropped,
+        }
+
+class MarketAlertEngine:
+    """Evaluates alert rules whenever a new price snapshot is published.
+
+    Rules fire per crop against PUNJAB_CROPS_DATA base prices. A rule that has
+    fired stays quiet until its alert expires, so a price hovering around a
+    threshold does not repeat itself. Alerts are written in batches for every
+    farmer growing the crop and pushed to live subscribers.
+    """
+
+    VALIDITY = {
+        "price_spike": timedelta(days=3),
+        "price_drop": timedelta(days=3),
+        "high_demand": timedelta(days=7),
+    }
+
+    def __init__(self, crops: Dict, broker: AlertBroker, spike_threshold: float, drop_threshold: float):
+        self.crops = crops
+        self.broker = broker
+        self.spike_threshold = spike_threshold
+        self.drop_threshold = drop_threshold
+        self.active: Dict[Tuple[str, str], datetime] = {}  # (crop, alert_type) -> valid_until of the last alert
+        self.last_version = None
+        self.lock = asyncio.Lock()
+        self.alerts_created = 0
+
+    def signals(self, snapshot: MarketPriceSnapshot) -> List[Dict]:
+        """Rules that hold for this snapshot, one per crop and alert type at the best mandi"""
+        by_crop: Dict[str, List[MarketPrice]] = {}
+        for price in snapshot.prices:
+            by_crop.setdefault(price.crop_name, []).append(price)
         
-        Note: This is based on the crop type and common issues. For accurate diagnosis, recommend consulting with local agricultural extension services.
-        """
+        signals = []
+        for crop, prices in by_crop.items():
+            base_price = self.crops[crop]["base_price"]
+            best = max(prices, key=lambda price: price.current_price)
+            change = best.current_price / base_price - 1
+            if change >= self.spike_threshold:
+                signals.append({
+                    "crop_name": crop,
+                    "alert_type": "price_spike",
+                    "message": f"Price spike for {crop} at {best.mandi_name}! Current rate: ₹{best.current_price:.2f}/quintal ({change:+.0%} on the usual rate)",
+                    "priority": "high" if change >= 2 * self.spike_threshold else "medium",
+                    "mandi_name": best.mandi_name,
+                    "price_offered": best.current_price,
+                })
+            elif change <= -self.drop_threshold:
+                signals.append({
+                    "crop_name": crop,
+                    "alert_type": "price_drop",
+                    "message": f"{crop} prices are down across mandis; the best rate is ₹{best.current_price:.2f}/quintal at {best.mandi_name}. Consider holding stock if storage allows.",
+                    "priority": "medium",
+                    "mandi_name": best.mandi_name,
+                    "price_offered": best.current_price,
+                })
+            
+            rising = [price for price in prices if price.demand_level == "high" and price.trend == "up"]
+            if rising:
+                mandi = max(rising, key=lambda price: price.current_price)
+                signals.append({
+                    "crop_name": crop,
+                    "alert_type": "high_demand",
+                    "message": f"High demand for {crop} at {mandi.mandi_name} with prices rising. Current rate: ₹{mandi.current_price:.2f}/quintal",
+                    "priority": "medium",
+                    "mandi_name": mandi.mandi_name,
+                    "price_offered": mandi.current_price,
+                })
+        return signals
+
+    async def load(self):
+        """Restore which rules are still covered by unexpired alerts after a restart"""
+        pipeline = [
+            {"$match": {"valid_until": {"$gt": datetime.now(timezone.utc)}}},
+            {"$group": {"_id": {"crop_name": "$crop_name", "alert_type": "$alert_type"}, "valid_until": {"$max": "$valid_until"}}},
+        ]
+        async for row in db.market_alerts.aggregate(pipeline):
+            self.active[(row["_id"]["crop_name"], row["_id"]["alert_type"])] = row["valid_until"]
+
+    async def evaluate(self, snapshot: MarketPriceSnapshot) -> int:
+        """Create alerts for rules that newly hold in this snapshot; returns how many were written"""
+        async with self.lock:
+            if snapshot.version == self.last_version:
+                return 0
+            self.last_version = snapshot.version
+            
+            now = datetime.now(timezone.utc)
+            fired = []
+            for signal in self.signals(snapshot):
+                key = (signal["crop_name"], signal["alert_type"])
+                if self.active.get(key, now) > now:
+                    continue
+                valid_until = now + self.VALIDITY[signal["alert_type"]]
+                self.active[key] = valid_until
+                fired.append({**signal, "valid_until": valid_until})
+            if not fired:
+                return 0
+            
+            # primary_crops is stored in canonical_crops form, so known crops match by exact name
+            crop_names = list({signal["crop_name"] for signal in fired})
+            cursor = db.farmer_profiles.find(
+                {"primary_crops": {"$in": crop_names}}, {"_id": 0, "id": 1, "primary_crops": 1}
+            ).batch_size(ALERT_INSERT_BATCH_SIZE)
+            
+            created = 0
+            batch: List[MarketAlert] = []
+            async for farmer in cursor:
+                farmer_crops = {canonical_crop(crop) for crop in farmer.get("primary_crops", [])}
+                batch.extend(
+                    MarketAlert(farmer_id=farmer["id"], **signal)
+                    for signal in fired if signal["crop_name"] in farmer_crops
+                )
+                if len(batch) >= ALERT_INSERT_BATCH_SIZE:
+                    created += await self.save(batch)
+                    batch = []
+            if batch:
+                created += await self.save(batch)
+            return created
+
+    async def save(self, alerts: List[MarketAlert]) -> int:
+        await db.market_alerts.insert_many([alert.dict() for alert in alerts], ordered=False)
+        self.broker.publish(alerts)
+        self.alerts_created += len(alerts)
+        return len(alerts)
+
+    def stats(self) -> Dict:
+        return {
+            "active_rules": sum(1 for valid_until in self.active.values() if valid_until > datetime.now(timezone.utc)),
+            "alerts_created": self.alerts_created,
+            "last_version": self.last_version,
+            **self.broker.stats(),
+        }
+
+alert_broker = AlertBroker(ALERT_SUBSCRIBER_QUEUE_SIZE)
+alert_engine = MarketAlertEngine(PUNJAB_CROPS_DATA, alert_broker, ALERT_SPIKE_THRESHOLD, ALERT_DROP_THRESHOLD)
+
+DEMAND_FORECAST_REFRESH_SECONDS = int(os.environ.get('DEMAND_FORECAST_REFRESH_SECONDS', str(6 * 60 * 60)))
+DEMAND_FORECAST_HISTORY_DAYS = int(os.environ.get('DEMAND_FORECAST_HISTORY_DAYS', '365'))
+
+class DemandForecaster:
+    """Damped Holt smoothing of daily log prices for every crop at once.
+
+    The seasonal component comes from the crop calendar (the engine's
+    post-harvest dip) rather than being estimated, since a full year of
+    history is rarely available. Arrival volumes are not recorded yet, so
+    price is the only demand signal.
+    """
+
+    ALPHA = 0.3
+    BETA = 0.1
+    PHI = 0.98
+    HORIZON_DAYS = {"3_months": 91, "6_months": 182}
+    CHANGE_THRESHOLD = 0.02
+    STRONG_CHANGE_THRESHOLD = 0.05
+    TREND_THRESHOLD = 0.01  # per 30 days
+    VOLATILITY_THRESHOLD = 0.03  # daily log-return standard deviation
+
+    def __init__(self, engine: MarketPriceEngine):
+        self.engine = engine
+
+    def smooth(self, log_prices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        level = log_prices[:, 0].copy()
+        trend = np.zeros_like(level)
+        for t in range(1, log_prices.shape[1]):
+            previous_level = level
+            level = self.ALPHA * log_prices[:, t] + (1 - self.ALPHA) * (level + self.PHI * trend)
+            trend = self.BETA * (level - previous_level) + (1 - self.BETA) * self.PHI * trend
+        return level, trend
+
+    def damped_steps(self, horizon: int) -> float:
+        return self.PHI * (1 - self.PHI ** horizon) / (1 - self.PHI)
+
+    def seasonal_level(self, when: datetime) -> np.ndarray:
+        return self.engine.long_run_level(when).mean(axis=1)
+
+    def forecast(self, daily_prices: np.ndarray, as_of: datetime) -> List[DemandForecast]:
+        """daily_prices has one row per engine crop and one column per day, oldest first"""
+        log_prices = np.log(daily_prices)
+        level, trend = self.smooth(log_prices)
         
-        user_message = UserMessage(text=analysis_query)
-        detection_result = await llm_chat.send_message(user_message)
+        changes = {}
+        for name, horizon in self.HORIZON_DAYS.items():
+            seasonal = np.log(self.seasonal_level(as_of + timedelta(days=horizon)) / self.seasonal_level(as_of))
+            changes[name] = np.exp(trend * self.damped_steps(horizon) + seasonal) - 1
         
-        response = PestDetectionResponse(
-            detection_result="Image analysis completed",
-            recommendations=detection_result
-        )
+        returns = np.diff(log_prices[:, -31:], axis=1)
+        volatility = returns.std(axis=1) if returns.shape[1] > 1 else np.zeros_like(level)
+        monthly_trend = trend * 30
+        pressure = np.exp(level) / self.seasonal_level(as_of) - 1
         
-        response_dict = response.dict()
-        response_dict['timestamp'] = response_dict['timestamp'].isoformat()
-        await db.pest_detection.insert_one(response_dict)
+        forecasts = []
+        for i, crop_name in enumerate(self.engine.crops):
+            change_3, change_6 = changes["3_months"][i], changes["6_months"][i]
+            if volatility[i] > self.VOLATILITY_THRESHOLD:
+                price_trend = "Volatile"
+            elif monthly_trend[i] > self.TREND_THRESHOLD:
+                price_trend = "Upward"
+            elif monthly_trend[i] < -self.TREND_THRESHOLD:
+                price_trend = "Downward"
+            else:
+                price_trend = "Stable"
+            
+            market_factors = []
+            harvest_months = PUNJAB_CROPS_DATA[crop_name]["harvest_months"]
+            upcoming = {(as_of + timedelta(days=30 * step)).month for step in range(4)}
+            if upcoming & set(harvest_months):
+                market_factors.append("Harvest arrivals expected within 3 months")
+            if pressure[i] > self.engine.DEMAND_THRESHOLD:
+                market_factors.append("Prices running above seasonal norm")
+            elif pressure[i] < -self.engine.DEMAND_THRESHOLD:
+                market_factors.append("Prices running below seasonal norm")
+            if price_trend in ("Upward", "Downward"):
+                market_factors.append(f"{price_trend} momentum over recent weeks")
+            if price_trend == "Volatile":
+                market_factors.append("High day-to-day price volatility")
+            if not market_factors:
+                market_factors.append("Prices in line with seasonal norm")
+            
+            forecasts.append(DemandForecast(
+                crop_name=crop_name,
+                current_demand="High" if pressure[i] > self.engine.DEMAND_THRESHOLD
+                else "Low" if pressure[i] < -self.engine.DEMAND_THRESHOLD else "Medium",
+                forecast_3_months="Increasing" if change_3 > self.CHANGE_THRESHOLD
+                else "Decreasing" if change_3 < -self.CHANGE_THRESHOLD else "Stable",
+                forecast_6_months="Strong Growth" if change_6 > self.STRONG_CHANGE_THRESHOLD
+                else "Decline Expected" if change_6 < -self.STRONG_CHANGE_THRESHOLD else "Stable",
+                price_trend=price_trend,
+                market_factors=market_factors
+            ))
+        return forecasts
+
+demand_forecaster = DemandForecaster(market_engine)
+
+class DemandForecastSnapshot:
+    """Forecasts served from memory, stamped with the run that produced them"""
+
+    def __init__(self, forecasts: Tuple[DemandForecast, ...], version: int, generated_at: datetime):
+        self.forecasts = forecasts
+        self.version = version
+        self.generated_at = generated_at
+        self._encoded: Optional["EncodedJson"] = None
+
+    def encoded(self) -> "EncodedJson":
+        if self._encoded is None:
+            self._encoded = EncodedJson([forecast.dict() for forecast in self.forecasts], self.generated_at)
+        return self._encoded
+
+forecast_snapshot: Optional[DemandForecastSnapshot] = None
+forecast_lock = asyncio.Lock()
+
+async def load_daily_prices(days: int) -> np.ndarray:
+    """Daily mean price per crop across mandis, forward-filled, shaped crops x days"""
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": since}}},
+        {"$group": {
+            "_id": {
+                "crop_name": "$meta.crop_name",
+                "day": {"$dateTrunc": {"date": "$timestamp", "unit": "day"}},
+            },
+            "price": {"$avg": "$price"},
+        }},
+        {"$sort": {"_id.day": 1}},
+    ]
+    crop_index = {crop: i for i, crop in enumerate(market_engine.crops)}
+    day_index = OrderedDict()
+    rows = []
+    async for row in db[MARKET_PRICE_TICKS].aggregate(pipeline):
+        if row["_id"]["crop_name"] in crop_index:
+            day_index.setdefault(row["_id"]["day"], len(day_index))
+            rows.append(row)
+    
+    daily = np.full((len(market_engine.crops), max(len(day_index), 1)), np.nan)
+    for row in rows:
+        daily[crop_index[row["_id"]["crop_name"]], day_index[row["_id"]["day"]]] = row["price"]
+    # Forward-fill gaps; series with no data at all start from the base price
+    daily[:, 0] = np.where(np.isnan(daily[:, 0]), market_engine.base_prices[:, 0], daily[:, 0])
+    for t in range(1, daily.shape[1]):
+        daily[:, t] = np.where(np.isnan(daily[:, t]), daily[:, t - 1], daily[:, t])
+    return daily
+
+async def refresh_demand_forecasts() -> DemandForecastSnapshot:
+    """Recompute every crop's forecast, store the run, then swap it in"""
+    global forecast_snapshot
+    async with forecast_lock:
+        generated_at = datetime.now(timezone.utc)
+        daily = await load_daily_prices(DEMAND_FORECAST_HISTORY_DAYS)
+        forecasts = demand_forecaster.forecast(daily, generated_at)
         
-        return response
+        latest = await db.demand_forecasts.find_one({}, {"_id": 0, "version": 1}, sort=[("version", DESCENDING)])
+        version = max(latest["version"] if latest else 0, forecast_snapshot.version if forecast_snapshot else 0) + 1
+        await db.demand_forecasts.insert_many([
+            {**forecast.dict(), "version": version, "generated_at": generated_at}
+            for forecast in forecasts
+        ])
+        await db.demand_forecasts.delete_many({"version": {"$lt": version}})
         
-    except Exception as e:
-        logger.error(f"Error in pest detection: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to analyze image: {str(e)}")
+        forecast_snapshot = DemandForecastSnapshot(tuple(forecasts), version, generated_at)
+        return forecast_snapshot
 
-@api_router.post("/farmer-profile", response_model=FarmerProfile)
-async def create_farmer_profile(profile: FarmerProfileCreate):
+async def load_demand_forecasts() -> DemandForecastSnapshot:
+    """Serve the latest stored run after a restart, computing one only if none exists"""
+    global forecast_snapshot
+    async with forecast_lock:
+        if forecast_snapshot is None:
+            latest = await db.demand_forecasts.find_one({}, {"_id": 0, "version": 1}, sort=[("version", DESCENDING)])
+            if latest:
+                docs = await db.demand_forecasts.find({"version": latest["version"]}, {"_id": 0}).to_list(None)
+                forecast_snapshot = DemandForecastSnapshot(
+                    tuple(DemandForecast(**doc) for doc in docs), latest["version"], docs[0]["generated_at"]
+                )
+    return forecast_snapshot or await refresh_demand_forecasts()
+
+async def get_forecast_snapshot() -> DemandForecastSnapshot:
+    return forecast_snapshot or await load_demand_forecasts()
+
+async def demand_forecast_refresher():
+    """Periodically recompute demand forecasts in the background"""
+    while True:
+        await asyncio.sleep(DEMAND_FORECAST_REFRESH_SECONDS)
+        try:
+            await refresh_demand_forecasts()
+        except Exception as e:
+            logger.error(f"Error refreshing demand forecasts: {str(e)}")
+
+# Keyset pagination; every sort ends on the unique "id" field so cursors are unambiguous
+PAGE_DEFAULT_LIMIT = 100
+PAGE_MAX_LIMIT = 500
+FARMER_PROFILES_SORT = [("created_at", DESCENDING), ("id", DESCENDING)]
+ADVICE_HISTORY_SORT = [("timestamp", DESCENDING), ("id", DESCENDING)]
+CROP_CALENDAR_SORT = [("sowing_date", ASCENDING), ("id", ASCENDING)]
+SYNC_ALERTS_SORT = [("created_at", ASCENDING), ("id", ASCENDING)]
+SYNC_PRICES_SORT = [("last_updated", ASCENDING)]  # lets full and delta syncs both use the last_updated index
+
+def encode_cursor(values: List) -> str:
+    """Pack the sort key of the last row into an opaque token"""
+    packed = [{"$dt": value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(packed).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(token: str) -> List:
     try:
-        farmer_obj = FarmerProfile(**profile.dict())
-        
-        farmer_dict = farmer_obj.dict()
-        farmer_dict['created_at'] = farmer_dict['created_at'].isoformat()
+        packed = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(packed, list):
+            raise ValueError("cursor is not a list")
+        return [
+            datetime.fromisoformat(value["$dt"]) if isinstance(value, dict) else value
+            for value in packed
+        ]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_query(query: Dict, sort: List[Tuple[str, int]], after: Optional[List]) -> Dict:
+    """Restrict query to rows strictly after the cursor position in sort order"""
+    if not after:
+        return query
+    if len(after) != len(sort):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    branches = []
+    for position, (field, direction) in enumerate(sort):
+        branch = {sort_field: after[index] for index, (sort_field, _) in enumerate(sort[:position])}
+        branch[field] = {"$gt" if direction == ASCENDING else "$lt": after[position]}
+        branches.append(branch)
+    return {"$and": [query, {"$or": branches}]} if query else {"$or": branches}
+
+async def fetch_page(collection, query: Dict, sort: List[Tuple[str, int]], limit: int,
+                     after: Optional[List], projection: Optional[Dict] = None) -> Tuple[List[Dict], Optional[str]]:
+    """Fetch one page of documents plus the cursor for the next page, if there is one"""
+    cursor = collection.find(keyset_query(query, sort, after), projection).sort(sort).limit(limit + 1)
+    docs = await cursor.to_list(limit + 1)
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    return docs, encode_cursor([docs[-1].get(field) for field, _ in sort])
+
+def model_projection(model) -> Dict:
+    """Project exactly the fields of a response model, dropping _id"""
+    return {"_id": 0, **{field: 1 for field in model.model_fields}}
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(content) -> bytes:
+    """Encode plain documents straight to JSON, without building a model per row"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC)
+    return json.dumps(content, default=_json_default, separators=(",", ":")).encode("utf-8")
+
+def json_response(rows: List[Dict], next_cursor: Optional[str] = None) -> Response:
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return Response(dump_json(rows), media_type="application/json", headers=headers)
+
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '5'))
+
+class EncodedJson:
+    """A JSON body with its ETag, compressed at most once per encoding so snapshots can reuse it"""
+
+    def __init__(self, content, last_modified: Optional[datetime] = None):
+        self.body = content if isinstance(content, bytes) else dump_json(content)
+        self.etag = f'W/"{hashlib.blake2b(self.body, digest_size=12).hexdigest()}"'
+        self.last_modified = last_modified
+        self._encoded: Dict[str, bytes] = {}
+
+    def encoded(self, encoding: str) -> bytes:
+        if encoding not in self._encoded:
+            if encoding == "br":
+                self._encoded[encoding] = brotli.compress(self.body, quality=COMPRESSION_BROTLI_QUALITY)
+            else:
+                self._encoded[encoding] = gzip.compress(self.body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+        return self._encoded[encoding]
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison, as If-None-Match requires"""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick br or gzip from Accept-Encoding, preferring brotli when it is installed"""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+def conditional_json_response(request: Request, encoded: EncodedJson, headers: Optional[Dict] = None) -> Response:
+    """Answer 304 when the client already has this body, otherwise send it compressed if it is large enough"""
+    headers = {"ETag": encoded.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding", **(headers or {})}
+    if encoded.last_modified is not None:
+        headers["Last-Modified"] = format_datetime(as_utc(encoded.last_modified).replace(microsecond=0), usegmt=True)
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, encoded.etag)
+    else:
+        not_modified = False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and encoded.last_modified is not None:
+            try:
+                not_modified = as_utc(encoded.last_modified).replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                pass
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    return compressed_json_response(request, encoded, headers)
+
+def compressed_json_response(request: Request, encoded: EncodedJson, headers: Optional[Dict] = None) -> Response:
+    headers = {"Vary": "Accept-Encoding", **(headers or {})}
+    body = encoded.body
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        encoding = accepted_encoding(request.headers.get("accept-encoding", ""))
+        if encoding:
+            body = encoded.encoded(encoding)
+            headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+# Indexes backing every query issued by the endpoints
+COLLECTION_INDEXES = {
+    "farmer_profiles": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        # One profile per phone number; profiles without a phone are not constrained
+        IndexModel([("phone", ASCENDING)], unique=True, partialFilterExpression={"phone": {"$type": "string"}}),
+        IndexModel([("primary_crops", ASCENDING)]),
+    ],
+    "crop_calendar": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("farmer_id", ASCENDING), ("sowing_date", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("farmer_id", ASCENDING), ("created_at", ASCENDING)]),
+    ],
+    "market_prices": [
+        IndexModel([("crop_name", ASCENDING), ("mandi_name", ASCENDING)], unique=True),
+        IndexModel([("last_updated", ASCENDING)]),
+    ],
+    "crop_advice": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("farmer_id", ASCENDING), ("timestamp", ASCENDING)]),
+    ],
+    "pest_detection": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("timestamp", DESCENDING)]),
+    ],
+    "market_alerts": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("farmer_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("created_at", ASCENDING)]),
+        # Drop alerts once they are past valid_until
+        IndexModel([("valid_until", ASCENDING)], expireAfterSeconds=0),
+    ],
+    MARKET_PRICE_TICKS: [
+        IndexModel([("meta.crop_name", ASCENDING), ("meta.mandi_name", ASCENDING), ("timestamp", ASCENDING)]),
+        # Restart warm-up and the forecasting aggregate select ticks by time alone
+        IndexModel([("timestamp", ASCENDING)]),
+    ],
+    "demand_forecasts": [
+        IndexModel([("version", DESCENDING)]),
+    ],
+    "recommendation_analyses": [
+        IndexModel([("farmer_id", ASCENDING)], unique=True),
+    ],
+    "advice_cache": [
+        IndexModel([("key", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+}
+
+PLAN_PROBE_TIME = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+# (name, collection, filter or aggregation pipeline, sort) for every query the app issues.
+# Export and next-page variants are added by endpoint_queries(). The one-off ISO date, phone
+# and crop name migrations are left out: they visit every document by design.
+ENDPOINT_QUERIES = [
+    ("farmer profile lookup", "farmer_profiles", {"id": "probe"}, None),
+    ("farmer profile listing", "farmer_profiles", {}, FARMER_PROFILES_SORT),
+    ("farmers growing a crop", "farmer_profiles", {"primary_crops": {"$in": ["Rice", "Wheat"]}}, None),
+    ("crop calendar by farmer", "crop_calendar", {"farmer_id": "probe"}, CROP_CALENDAR_SORT),
+    ("calendar changes by farmer", "crop_calendar", {"farmer_id": "probe", "created_at": {"$gt": PLAN_PROBE_TIME}}, CROP_CALENDAR_SORT),
+    ("market price upsert key", "market_prices", {"crop_name": "Rice", "mandi_name": "Ludhiana Mandi"}, None),
+    ("market prices for full sync", "market_prices", {}, SYNC_PRICES_SORT),
+    ("market price changes", "market_prices", {"last_updated": {"$gt": PLAN_PROBE_TIME}}, SYNC_PRICES_SORT),
+    ("price ticks since restart window", MARKET_PRICE_TICKS, {"timestamp": {"$gte": PLAN_PROBE_TIME}}, [("timestamp", ASCENDING)]),
+    ("market price history", MARKET_PRICE_TICKS, [
+        {"$match": {"meta.crop_name": "Rice", "timestamp": {"$gte": PLAN_PROBE_TIME}}},
+    ], None),
+    ("daily prices for forecasting", MARKET_PRICE_TICKS, [{"$match": {"timestamp": {"$gte": PLAN_PROBE_TIME}}}], None),
+    ("latest forecast version", "demand_forecasts", {}, [("version", DESCENDING)]),
+    ("forecast run", "demand_forecasts", {"version": 1}, None),
+    ("superseded forecast runs", "demand_forecasts", {"version": {"$lt": 1}}, None),
+    ("advice history", "crop_advice", {}, ADVICE_HISTORY_SORT),
+    ("advice cache lookup", "advice_cache", {"key": "probe", "expires_at": {"$gt": PLAN_PROBE_TIME}}, None),
+    ("market alerts by farmer", "market_alerts", {"farmer_id": "probe", "created_at": {"$gt": PLAN_PROBE_TIME}}, [("created_at", DESCENDING)]),
+    ("alert changes by farmer", "market_alerts", {"farmer_id": "probe", "created_at": {"$gt": PLAN_PROBE_TIME}}, SYNC_ALERTS_SORT),
+    ("active alert rules", "market_alerts", [{"$match": {"valid_until": {"$gt": PLAN_PROBE_TIME}}}], None),
+    ("cached recommendation analysis", "recommendation_analyses", {"farmer_id": "probe", "fingerprint": "probe", "season": "probe"}, None),
+    ("recent pest hashes", "pest_detection", {"timestamp": {"$gte": PLAN_PROBE_TIME}, "image_hash": {"$exists": True}}, [("timestamp", DESCENDING)]),
+    ("migration marker", "schema_migrations", {"_id": "probe"}, None),
+]
+
+async def ensure_indexes():
+    """Create any missing indexes; existing ones are left untouched"""
+    for collection_name, indexes in COLLECTION_INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(indexes)
+        except Exception as e:
+            logger.error(f"Error creating indexes on {collection_name}: {str(e)}")
+
+def _plan_stages(plan) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+def _winning_plan_stages(explanation) -> List[str]:
+    """Stages of every winning plan in an explain, including those nested in aggregation stages"""
+    stages = []
+    if isinstance(explanation, dict):
+        for key, value in explanation.items():
+            stages.extend(_plan_stages(value) if key == "winningPlan" else _winning_plan_stages(value))
+    elif isinstance(explanation, list):
+        for value in explanation:
+            stages.extend(_winning_plan_stages(value))
+    return stages
+
+def endpoint_queries() -> List[Tuple[str, str, object, Optional[List[Tuple[str, int]]]]]:
+    """ENDPOINT_QUERIES plus the paging and export variants, built from the constants the handlers use"""
+    queries = list(ENDPOINT_QUERIES)
+    for name, collection_name, query, sort in ENDPOINT_QUERIES:
+        if sort in (FARMER_PROFILES_SORT, ADVICE_HISTORY_SORT, CROP_CALENDAR_SORT, SYNC_ALERTS_SORT):
+            queries.append((f"{name}, next page", collection_name, keyset_query(query, sort, [PLAN_PROBE_TIME, "probe"]), sort))
+    for dataset, (collection_name, time_field, has_farmer) in EXPORT_COLLECTIONS.items():
+        sort = [(time_field, ASCENDING)]
+        bounds = {time_field: {"$gte": PLAN_PROBE_TIME, "$lt": PLAN_PROBE_TIME + timedelta(days=1)}}
+        queries.append((f"{dataset} export", collection_name, {}, sort))
+        queries.append((f"{dataset} export by time", collection_name, bounds, sort))
+        if has_farmer:
+            queries.append((f"{dataset} export by farmer", collection_name, {"farmer_id": "probe", **bounds}, sort))
+    return queries
+
+async def find_collection_scans() -> List[str]:
+    """Explain every query the app issues and return the names of those that fall back to a COLLSCAN"""
+    offenders = []
+    for name, collection_name, query, sort in endpoint_queries():
+        if isinstance(query, list):
+            explanation = await db.command("aggregate", collection_name, pipeline=query, explain=True)
+        else:
+            cursor = db[collection_name].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explanation = await cursor.explain()
+        if "COLLSCAN" in _winning_plan_stages(explanation):
+            offenders.append(name)
+    return offenders
+
+# Date fields that older deployments stored as ISO strings
+DATETIME_FIELDS = {
+    "farmer_profiles": ["created_at"],
+    "crop_advice": ["timestamp"],
+    "pest_detection": ["timestamp"],
+    "crop_calendar": ["sowing_date", "harvesting_date", "recommended_selling_date", "created_at"],
+    "market_prices": ["last_updated"],
+    "market_alerts": ["valid_until", "created_at"],
+}
+MIGRATION_BATCH_SIZE = 1000
+
+async def migrate_iso_datetimes():
+    """One-off conversion of ISO string dates to native BSON dates, recorded in schema_migrations"""
+    migration_id = "native_datetimes"
+    if await db.schema_migrations.find_one({"_id": migration_id}):
+        return
+    
+    for collection_name, fields in DATETIME_FIELDS.items():
+        collection = db[collection_name]
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        projection = {field: 1 for field in fields}
+        operations = []
+        converted = 0
+        async for doc in collection.find(query, projection).batch_size(MIGRATION_BATCH_SIZE):
+            updates = {
+                field: datetime.fromisoformat(doc[field])
+                for field in fields if isinstance(doc.get(field), str)
+            }
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": updates}))
+            if len(operations) >= MIGRATION_BATCH_SIZE:
+                await collection.bulk_write(operations, ordered=False)
+                converted += len(operations)
+                operations = []
+        if operations:
+            await collection.bulk_write(operations, ordered=False)
+            converted += len(operations)
+        if converted:
+            logger.info(f"Converted ISO string dates in {converted} {collection_name} documents")
+    
+    await db.schema_migrations.insert_one({"_id": migration_id, "applied_at": datetime.now(timezone.utc)})
+
+async def migrate_phone_numbers():
+    """One-off rewrite of stored phones to canonical_phone form, so the unique phone index sees legacy rows.
+
+    When several profiles share a number after normalization, the oldest keeps it; the others
+    get phone=None with the original kept in phone_conflict for manual review. The number ->
+    owner map is held in memory for the duration of the migration.
+    """
+    migration_id = "canonical_phones"
+    if await db.schema_migrations.find_one({"_id": migration_id}):
+        return
+    
+    query = {"phone": {"$type": "string"}}
+    owners = {}
+    async for doc in db.farmer_profiles.find(query, {"phone": 1}).sort([("created_at", ASCENDING), ("id", ASCENDING)]).batch_size(MIGRATION_BATCH_SIZE):
+        owners.setdefault(canonical_phone(doc["phone"]), doc["_id"])
+    
+    # Free conflicting numbers before normalizing, so the unique index never rejects the owner's rewrite
+    counts = {}
+    for step in ("conflicts", "normalized"):
+        operations = []
+        counts[step] = 0
+        async for doc in db.farmer_profiles.find(query, {"phone": 1}).batch_size(MIGRATION_BATCH_SIZE):
+            phone = canonical_phone(doc["phone"])
+            if step == "conflicts" and owners.get(phone) != doc["_id"]:
+                update = {"$set": {"phone": None, "phone_conflict": doc["phone"]}}
+            elif step == "normalized" and phone != doc["phone"]:
+                update = {"$set": {"phone": phone}}
+            else:
+                continue
+            operations.append(UpdateOne({"_id": doc["_id"]}, update))
+            if len(operations) >= MIGRATION_BATCH_SIZE:
+                await db.farmer_profiles.bulk_write(operations, ordered=False)
+                counts[step] += len(operations)
+                operations = []
+        if operations:
+            await db.farmer_profiles.bulk_write(operations, ordered=False)
+            counts[step] += len(operations)
+    if counts["conflicts"] or counts["normalized"]:
+        logger.info(f"Normalized {counts['normalized']} farmer phones; {counts['conflicts']} duplicates moved to phone_conflict")
+    
+    await db.schema_migrations.insert_one({"_id": migration_id, "applied_at": datetime.now(timezone.utc)})
+
+async def migrate_crop_names():
+    """One-off rewrite of stored primary_crops to canonical_crops form, so market alerts find every grower"""
+    migration_id = "canonical_crops"
+    if await db.schema_migrations.find_one({"_id": migration_id}):
+        return
+    
+    operations = []
+    updated = 0
+    async for doc in db.farmer_profiles.find({}, {"primary_crops": 1}).batch_size(MIGRATION_BATCH_SIZE):
+        crops = doc.get("primary_crops") or []
+        if canonical_crops(crops) == crops:
+            continue
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"primary_crops": canonical_crops(crops)}}))
+        if len(operations) >= MIGRATION_BATCH_SIZE:
+            await db.farmer_profiles.bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+    if operations:
+        await db.farmer_profiles.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    if updated:
+        logger.info(f"Normalized primary_crops on {updated} farmer profiles")
+    
+    await db.schema_migrations.insert_one({"_id": migration_id, "applied_at": datetime.now(timezone.utc)})
+
+background_tasks: List[asyncio.Task] = []
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    background_tasks.append(task)
+    return task
+
+WRITE_BEHIND_MAX_SIZE = int(os.environ.get('WRITE_BEHIND_MAX_SIZE', '10000'))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', '500'))
+WRITE_BEHIND_FLUSH_SECONDS = float(os.environ.get('WRITE_BEHIND_FLUSH_SECONDS', '1'))
+WRITE_BEHIND_BLOCK_SECONDS = 0.5  # how long a writer waits on a full buffer before its document is dropped
+
+class WriteBehindBuffer:
+    """Batches log writes off the request path.
+
+    Handlers enqueue documents and return; a flusher writes them with one
+    insert_many per collection once batch_size documents are waiting or
+    flush_seconds have passed. When the buffer is full, writers wait briefly
+    (backpressure) and then drop the document rather than stall the request.
+    Documents still buffered when the process dies are lost, so only audit
+    logs go through here.
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_seconds: float):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue = None
+        self._task = None
+        self.written = 0
+        self.batches = 0
+        self.blocked = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._task = asyncio.ensure_future(self._flusher())
+
+    async def write(self, collection_name: str, document: Dict):
+        if self._task is None or self._task.done():
+            # Not running (scripts, or after shutdown): write through
+            await db[collection_name].insert_one(document)
+            return
+        try:
+            self._queue.put_nowait((collection_name, document))
+        except asyncio.QueueFull:
+            self.blocked += 1
+            try:
+                await asyncio.wait_for(self._queue.put((collection_name, document)), WRITE_BEHIND_BLOCK_SECONDS)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                logger.warning(f"Write-behind buffer full; dropped a {collection_name} document")
+
+    async def _next_batch(self) -> List[Tuple[str, Dict]]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush(self, batch: List[Tuple[str, Dict]]):
+        by_collection: Dict[str, List[Dict]] = {}
+        for collection_name, document in batch:
+            by_collection.setdefault(collection_name, []).append(document)
+        for collection_name, documents in by_collection.items():
+            try:
+                await db[collection_name].insert_many(documents, ordered=False)
+                self.written += len(documents)
+            except Exception as e:
+                self.failed += len(documents)
+                logger.error(f"Error flushing {len(documents)} {collection_name} documents: {str(e)}")
+        self.batches += 1
+        for _ in batch:
+            self._queue.task_done()
+
+    async def _flusher(self):
+        while True:
+            await self._flush(await self._next_batch())
+
+    async def drain(self, timeout: float = 10):
+        """Flush everything still buffered, then stop the flusher"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Write-behind drain timed out with {self._queue.qsize()} documents unwritten")
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "depth": self._queue.qsize() if self._queue else 0,
+            "max_size": self.max_size,
+            "written": self.written,
+            "batches": self.batches,
+            "blocked": self.blocked,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+write_behind = WriteBehindBuffer(WRITE_BEHIND_MAX_SIZE, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_SECONDS)
+
+class CropCalendarPlanner:
+    """Scores every candidate sowing month and selling delay for many farmer x crop pairs in one NumPy pass.
+
+    A window's score is the expected price factor on the selling date (the
+    seasonal post-harvest dip, plus today's market premium fading out over a
+    few months), less a storage cost for holding the harvest and a small cost
+    for waiting longer to sow. The highest-scoring window wins.
+    """
+
+    SALE_DELAYS = np.arange(7, 64, 7)  # days after harvest considered for selling
+    STORAGE_COST_PER_DAY = 0.0005  # share of the price lost per day the harvest is held
+    WAIT_COST_PER_DAY = 0.0002  # preference for sowing sooner rather than a year out
+    MONSOON_MONTHS = [7, 8, 9]
+    STRESS_SOWING_MONTHS = [5, 6, 12, 1]  # heat or frost at establishment
+    PREMIUM_DECAY_DAYS = 90
+
+    def __init__(self, crops: Dict, harvest_discount: float):
+        self.crops = list(crops)
+        self.index = {crop: i for i, crop in enumerate(self.crops)}
+        width = max(len(crops[crop]["sowing_months"]) for crop in self.crops)
+        self.sowing_months = np.ones((len(self.crops), width), dtype=int)
+        self.valid = np.zeros((len(self.crops), width), dtype=bool)
+        self.seasonal = np.ones((len(self.crops), 12))
+        for i, crop in enumerate(self.crops):
+            months = crops[crop]["sowing_months"]
+            self.sowing_months[i, :len(months)] = months
+            self.valid[i, :len(months)] = True
+            self.seasonal[i, [month - 1 for month in crops[crop]["harvest_months"]]] -= harvest_discount
+        self.growing_days = np.array([crops[crop]["growing_days"] for crop in self.crops])
+        self.yields = np.array([crops[crop]["avg_yield_per_acre"] for crop in self.crops], dtype=float)
+        self.base_prices = np.array([crops[crop]["base_price"] for crop in self.crops], dtype=float)
+
+    @staticmethod
+    def _to_datetimes(dates: np.ndarray) -> List[datetime]:
+        return [value.replace(tzinfo=timezone.utc) for value in dates.astype("datetime64[ms]").astype(datetime).tolist()]
+
+    @staticmethod
+    def _months(dates: np.ndarray) -> np.ndarray:
+        return dates.astype("datetime64[M]").astype(int) % 12 + 1
+
+    def plan(self, crop_names: List[str], today: Optional[datetime] = None,
+             price_ratios: Optional[Dict[str, float]] = None) -> List[Dict]:
+        """Return the best window for each crop name; every name must be a PUNJAB_CROPS_DATA key.
+
+        price_ratios maps crop names to current price / base price.
+        """
+        if not crop_names:
+            return []
+        today = np.datetime64((today or datetime.now(timezone.utc)).date(), "D")
+        crops = np.array([self.index[crop_name] for crop_name in crop_names])
+        months = self.sowing_months[crops] - 1
+        
+        # Sow on the 15th of each candidate month, rolling over to next year once it has passed
+        year_start = today.astype("datetime64[Y]")
+        this_year = (year_start.astype("datetime64[M]") + months).astype("datetime64[D]") + 14
+        next_year = ((year_start + 1).astype("datetime64[M]") + months).astype("datetime64[D]") + 14
+        sowing = np.where(this_year < today, next_year, this_year)
+        harvest = sowing + self.growing_days[crops][:, None].astype("timedelta64[D]")
+        selling = harvest[:, :, None] + self.SALE_DELAYS.astype("timedelta64[D]")
+        
+        price_factor = self.seasonal[crops[:, None, None], self._months(selling) - 1]
+        if price_ratios:
+            premium = np.array([price_ratios.get(crop, 1.0) for crop in self.crops])[crops] - 1
+            days_to_sale = (selling - today).astype(int)
+            price_factor = price_factor * (1 + premium[:, None, None] * np.exp(-days_to_sale / self.PREMIUM_DECAY_DAYS))
+        wait_days = (sowing - today).astype(int)
+        score = (
+            price_factor * (1 - self.STORAGE_COST_PER_DAY * self.SALE_DELAYS)
+            - self.WAIT_COST_PER_DAY * wait_days[:, :, None]
+        )
+        score = np.where(self.valid[crops][:, :, None], score, -np.inf)
+        
+        best = score.reshape(len(crops), -1).argmax(axis=1)
+        rows = np.arange(len(crops))
+        window, delay = np.divmod(best, len(self.SALE_DELAYS))
+        best_sowing = sowing[rows, window]
+        best_harvest = harvest[rows, window]
+        best_selling = selling[rows, window, delay]
+        best_factor = price_factor[rows, window, delay]
+        
+        weather_risk = np.where(
+            np.isin(self._months(best_harvest), self.MONSOON_MONTHS), "High",
+            np.where(np.isin(self._months(best_sowing), self.STRESS_SOWING_MONTHS), "Medium", "Low")
+        )
+        estimated_price = np.round(self.base_prices[crops] * best_factor, 2)
+        demand_score = np.round(np.clip(0.5 + 5 * (best_factor - 1), 0, 1), 3)
+        
+        return [
+            {
+                "sowing_date": sowing_date,
+                "harvest_date": harvest_date,
+                "selling_date": selling_date,
+                "expected_yield": float(self.yields[crop]),
+                "estimated_price": float(price),
+                "market_demand_score": float(demand),
+                "weather_risk": str(risk),
+            }
+            for sowing_date, harvest_date, selling_date, crop, price, demand, risk in zip(
+                self._to_datetimes(best_sowing), self._to_datetimes(best_harvest),
+                self._to_datetimes(best_selling), crops, estimated_price, demand_score, weather_risk
+            )
+        ]
+
+calendar_planner = CropCalendarPlanner(PUNJAB_CROPS_DATA, MarketPriceEngine.HARVEST_DISCOUNT)
+
+def current_price_ratios() -> Optional[Dict[str, float]]:
+    """Average current price across mandis relative to base price, per crop"""
+    if market_snapshot is None:
+        return None
+    totals = {}
+    for price in market_snapshot.prices:
+        totals.setdefault(price.crop_name, []).append(price.current_price)
+    return {
+        crop: sum(prices) / len(prices) / PUNJAB_CROPS_DATA[crop]["base_price"]
+        for crop, prices in totals.items() if crop in PUNJAB_CROPS_DATA
+    }
+
+def calculate_optimal_calendar(crop_name: str, location: str):
+    """Calculate optimal sowing, harvesting and selling dates"""
+    if crop_name not in PUNJAB_CROPS_DATA:
+        return None
+    return calendar_planner.plan([crop_name], price_ratios=current_price_ratios())[0]
+
+@api_router.get("/")
+async def root():
+    return {"message": "Smart Crop Advisory System API"}
+
+def build_advice_prompt(request: CropAdviceRequest) -> str:
+    """Construct detailed query"""
+    return f"""
+        Farmer Question: {request.query}
+        Crop Type: {request.crop_type or 'Not specified'}
+        Location: {request.location or 'Not specified'}
+        Language: {request.language}
+        
+        Please provide specific, actionable advice for this farmer's situation considering Punjab/Haryana agricultural conditions.
+        """
+
+async def save_crop_advice(advice_obj: CropAdviceResponse):
+    advice_dict = advice_obj.dict()
+    await write_behind.write("crop_advice", advice_dict)
+
+@api_router.post("/crop-advice", response_model=CropAdviceResponse)
+async def get_crop_advice(request: CropAdviceRequest):
+    try:
+        try:
+            if request.farmer_id:
+                # Follow-up questions build on the farmer's own session, so they bypass the shared cache
+                advice = await ask_llm(build_advice_prompt(request), session_id=f"farmer:{request.farmer_id}")
+            else:
+                cache_key = advice_cache_key(request)
+                advice = await advice_cache.get(cache_key)
+                if advice is None:
+                    enhanced_query = build_advice_prompt(request)
+                    
+                    async def generate_advice():
+                        started = time.perf_counter()
+                        result = await ask_llm(enhanced_query)
+                        await advice_cache.set(cache_key, result, time.perf_counter() - started)
+                        return result
+                    
+                    # Requests that normalize to the same key share one LLM call and cache write
+                    advice = await llm_single_flight.do(f"crop-advice:{cache_key}", generate_advice)
+        except LlmUnavailable as e:
+            # Fallback answers are neither cached nor stored in the history
+            logger.warning(f"Serving fallback crop advice: {str(e)}")
+            return CropAdviceResponse(
+                query=request.query,
+                advice=fallback_crop_advice(request.crop_type, request.location),
+                farmer_id=request.farmer_id
+            )
+        
+        # Save to database
+        advice_obj = CropAdviceResponse(
+            query=request.query,
+            advice=advice,
+            farmer_id=request.farmer_id
+        )
+        
+        await save_crop_advice(advice_obj)
+        
+        return advice_obj
+        
+    except Exception as e:
+        logger.error(f"Error getting crop advice: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get crop advice: {str(e)}")
+
+@api_router.post("/crop-advice/stream")
+async def stream_crop_advice(request: CropAdviceRequest):
+    """Stream crop advice as server-sent events so the first tokens arrive immediately"""
+    # Follow-up questions are answered in the farmer's session, as in get_crop_advice, and bypass the shared cache
+    cache_key = None if request.farmer_id else advice_cache_key(request)
+    cached_advice = await advice_cache.get(cache_key) if cache_key else None
+    advice_id = str(uuid.uuid4())
+    
+    async def events():
+        # Flush an event right away so slow links see the response start
+        yield sse_event("start", {"id": advice_id, "query": request.query})
+        try:
+            if request.farmer_id:
+                # The session's history lives in its LlmChat, so the turn is sent there and arrives as one chunk
+                advice = await ask_llm(build_advice_prompt(request), session_id=f"farmer:{request.farmer_id}")
+                yield sse_event("token", {"text": advice})
+            elif cached_advice is not None:
+                advice = cached_advice
+                yield sse_event("token", {"text": advice})
+            else:
+                chunks = []
+                started = time.perf_counter()
+                async with aclosing(stream_llm(build_advice_prompt(request))) as stream:
+                    async for chunk in stream:
+                        chunks.append(chunk)
+                        yield sse_event("token", {"text": chunk})
+                advice = "".join(chunks)
+                await advice_cache.set(cache_key, advice, time.perf_counter() - started)
+            
+            advice_obj = CropAdviceResponse(
+                id=advice_id, query=request.query, advice=advice, farmer_id=request.farmer_id
+            )
+            await save_crop_advice(advice_obj)
+            yield sse_event("done", json.loads(advice_obj.json()))
+            
+        except LlmUnavailable as e:
+            logger.warning(f"Serving fallback crop advice: {str(e)}")
+            advice_obj = CropAdviceResponse(
+                id=advice_id, query=request.query,
+                advice=fallback_crop_advice(request.crop_type, request.location), farmer_id=request.farmer_id
+            )
+            yield sse_event("token", {"text": advice_obj.advice})
+            yield sse_event("done", json.loads(advice_obj.json()))
+        except Exception as e:
+            logger.error(f"Error streaming crop advice: {str(e)}")
+            yield sse_event("error", {"detail": f"Failed to get crop advice: {str(e)}"})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Limits for uploaded pest photos
+PEST_UPLOAD_MAX_BYTES = int(os.environ.get('PEST_UPLOAD_MAX_BYTES', str(10 * 1024 * 1024)))
+PEST_IMAGE_MAX_PIXELS = int(os.environ.get('PEST_IMAGE_MAX_PIXELS', str(50_000_000)))
+PEST_IMAGE_MAX_DIMENSION = int(os.environ.get('PEST_IMAGE_MAX_DIMENSION', '1024'))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+def prepare_pest_image(data: bytes) -> Image.Image:
+    """Decode, EXIF-orient and downscale a photo; blocking, so run it in a worker thread"""
+    with Image.open(io.BytesIO(data)) as image:
+        # Only the header has been read so far, so oversized images are rejected before decoding
+        if image.width * image.height > PEST_IMAGE_MAX_PIXELS:
+            raise ValueError(f"Image is too large ({image.width}x{image.height})")
+        # Let JPEG decode straight at a reduced scale instead of full resolution
+        image.draft("RGB", (PEST_IMAGE_MAX_DIMENSION, PEST_IMAGE_MAX_DIMENSION))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((PEST_IMAGE_MAX_DIMENSION, PEST_IMAGE_MAX_DIMENSION))
+    return image
+
+def limit_request_body(request: Request, max_bytes: int, detail: str) -> Request:
+    """The same request, but reading its body fails with 413 once more than max_bytes have arrived.
+
+    Content-Length is only checked up front when the client sends it; this also caps chunked bodies,
+    which request.form() would otherwise spool in full before read_upload sees the file.
+    """
+    received = 0
+    
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > max_bytes:
+                raise HTTPException(status_code=413, detail=detail)
+        return message
+    
+    return Request(request.scope, receive)
+
+async def read_upload(upload: UploadFile, max_bytes: int) -> bytes:
+    """Read an upload in chunks, giving up as soon as it exceeds max_bytes"""
+    data = bytearray()
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        data.extend(chunk)
+        if len(data) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Image exceeds {max_bytes} bytes")
+    return bytes(data)
+
+def dhash(image: Image.Image, hash_size: int = 8) -> str:
+    """64-bit difference hash: near-identical photos differ in only a few bits"""
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return f"{value:016x}"
+
+def hamming_distance(first: str, second: str) -> int:
+    return bin(int(first, 16) ^ int(second, 16)).count("1")
+
+def pest_image_hash(data: bytes) -> str:
+    return dhash(prepare_pest_image(data))
+
+async def hash_pest_image(data: bytes) -> str:
+    """Validate, downscale and hash a photo off the event loop"""
+    try:
+        return await asyncio.to_thread(pest_image_hash, data)
+    except (ValueError, OSError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {str(e)}")
+
+def decode_image_base64(image_base64: str) -> bytes:
+    # Accept data URLs as produced by FileReader.readAsDataURL
+    if image_base64.startswith("data:") and "," in image_base64:
+        image_base64 = image_base64.split(",", 1)[1]
+    return base64.b64decode(image_base64, validate=False)
+
+def base64_image_job(crop_type: Optional[str], image_base64: str) -> Tuple[Optional[str], object]:
+    """A run_pest_batch job; an image that would decode past PEST_UPLOAD_MAX_BYTES fails without being decoded"""
+    # Every 4 base64 characters carry 3 bytes, so this bounds the decoded size from above
+    if len(image_base64) // 4 * 3 > PEST_UPLOAD_MAX_BYTES:
+        return crop_type, ValueError(f"Image exceeds {PEST_UPLOAD_MAX_BYTES} bytes")
+    return crop_type, image_base64
+
+PEST_HASH_MAX_DISTANCE = int(os.environ.get('PEST_HASH_MAX_DISTANCE', '6'))
+PEST_HASH_WINDOW_SECONDS = int(os.environ.get('PEST_HASH_WINDOW_SECONDS', str(6 * 60 * 60)))
+PEST_HASH_INDEX_SIZE = int(os.environ.get('PEST_HASH_INDEX_SIZE', '5000'))
+
+class PestHashIndex:
+    """Recent pest diagnoses by perceptual hash, held in memory.
+
+    Filled from db.pest_detection once at startup and on every new diagnosis, so a
+    lookup never goes to Mongo. Near-duplicates first diagnosed by another worker
+    after startup are not reused; that costs one extra LLM call, not a wrong answer.
+    """
+
+    def __init__(self, collection, max_distance: int, window_seconds: int, max_entries: int):
+        self.collection = collection
+        self.max_distance = max_distance
+        self.window_seconds = window_seconds
+        self._recent = deque(maxlen=max_entries)  # (timestamp, crop_type, image_hash, response)
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, crop_type: str, image_hash: str, response: PestDetectionResponse):
+        self._recent.append((as_utc(response.timestamp), crop_type, image_hash, response))
+
+    async def load(self):
+        """Restore the diagnoses still inside the window after a restart"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.window_seconds)
+        docs = await self.collection.find(
+            {"timestamp": {"$gte": cutoff}, "image_hash": {"$exists": True}}, {"_id": 0}
+        ).sort("timestamp", DESCENDING).limit(self._recent.maxlen).to_list(self._recent.maxlen)
+        self._recent.clear()
+        for doc in reversed(docs):
+            crop_type = doc.pop("crop_type", None)
+            image_hash = doc.pop("image_hash")
+            self.add(crop_type, image_hash, PestDetectionResponse(**doc))
+
+    async def find(self, crop_type: str, image_hash: str) -> Optional[PestDetectionResponse]:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.window_seconds)
+        while self._recent and self._recent[0][0] < cutoff:
+            self._recent.popleft()
+        for timestamp, recent_crop, recent_hash, response in reversed(self._recent):
+            if recent_crop == crop_type and hamming_distance(recent_hash, image_hash) <= self.max_distance:
+                self.hits += 1
+                return response
+        self.misses += 1
+        return None
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._recent),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+pest_hash_index = PestHashIndex(
+    db.pest_detection, PEST_HASH_MAX_DISTANCE, PEST_HASH_WINDOW_SECONDS, PEST_HASH_INDEX_SIZE
+)
+
+async def diagnose_pest(crop_type: Optional[str], image_hash: Optional[str] = None) -> Tuple[PestDetectionResponse, Optional[Dict]]:
+    """Return the diagnosis plus the document to persist, or None when it came from the hash index"""
+    crop_key = canonical_crop(crop_type)
+    if image_hash:
+        cached = await pest_hash_index.find(crop_key, image_hash)
+        if cached:
+            return cached, None
+    
+    analysis_query = f"""
+        A farmer has uploaded an image of their {crop_type or 'crop'} that they suspect has pest or disease issues.
+        
+        Based on common pest and disease patterns for {crop_type or 'crops'} in Punjab/Haryana region, provide:
+        1. Likely pest/disease identification
+        2. Immediate treatment recommendations
+        3. Prevention strategies
+        4. When to seek professional help
+        
+        Note: This is based on the crop type and common issues. For accurate diagnosis, recommend consulting with local agricultural extension services.
+        """
+    
+    try:
+        detection_result = await ask_llm(analysis_query)
+    except LlmUnavailable as e:
+        logger.warning(f"Serving fallback pest advice: {str(e)}")
+        return PestDetectionResponse(
+            detection_result="Image analysis unavailable",
+            recommendations=fallback_pest_advice(crop_type)
+        ), None
+    
+    response = PestDetectionResponse(
+        detection_result="Image analysis completed",
+        recommendations=detection_result
+    )
+    
+    response_dict = response.dict()
+    response_dict['crop_type'] = crop_key
+    if image_hash:
+        response_dict['image_hash'] = image_hash
+        pest_hash_index.add(crop_key, image_hash, response)
+    
+    return response, response_dict
+
+async def analyze_pest(crop_type: Optional[str], image_hash: Optional[str] = None) -> PestDetectionResponse:
+    response, response_dict = await diagnose_pest(crop_type, image_hash)
+    if response_dict:
+        await write_behind.write("pest_detection", response_dict)
+    return response
+
+async def try_hash_image_base64(image_base64: str) -> Optional[str]:
+    try:
+        return await asyncio.to_thread(pest_image_hash, decode_image_base64(image_base64))
+    except Exception as e:
+        # Unreadable images are still analysed from the crop type, just without dedupe
+        logger.warning(f"Could not hash pest image: {str(e)}")
+        return None
+
+@api_router.post("/pest-detection", response_model=PestDetectionResponse)
+async def detect_pest(request: PestDetectionRequest):
+    image_hash = await try_hash_image_base64(request.image_base64)
+    
+    try:
+        return await analyze_pest(request.crop_type, image_hash)
+        
+    except Exception as e:
+        logger.error(f"Error in pest detection: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to analyze image: {str(e)}")
+
+@api_router.post("/pest-detection/upload", response_model=PestDetectionResponse)
+async def detect_pest_upload(request: Request):
+    """Analyze a crop photo sent as multipart/form-data (fields: file, crop_type)"""
+    # Refuse declared-oversize bodies before reading any of them
+    max_body = PEST_UPLOAD_MAX_BYTES + UPLOAD_CHUNK_SIZE
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_body:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {PEST_UPLOAD_MAX_BYTES} bytes")
+    
+    # Starlette spools file parts to disk past 1 MB, so parsing does not hold the whole body in memory
+    request = limit_request_body(request, max_body, f"Image exceeds {PEST_UPLOAD_MAX_BYTES} bytes")
+    form = await request.form(max_files=1, max_fields=5)
+    upload = form.get("file")
+    if upload is None or isinstance(upload, str):
+        raise HTTPException(status_code=400, detail="Missing image file")
+    crop_type = form.get("crop_type") or None
+    
+    try:
+        data = await read_upload(upload, PEST_UPLOAD_MAX_BYTES)
+    finally:
+        await form.close()
+    image_hash = await hash_pest_image(data)
+    
+    try:
+        return await analyze_pest(crop_type, image_hash)
+        
+    except Exception as e:
+        logger.error(f"Error in pest detection: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to analyze image: {str(e)}")
+
+PEST_BATCH_MAX_ITEMS = int(os.environ.get('PEST_BATCH_MAX_ITEMS', '50'))
+PEST_BATCH_CONCURRENCY = int(os.environ.get('PEST_BATCH_CONCURRENCY', '4'))
+
+async def run_pest_batch(jobs: List[Tuple[Optional[str], object]]) -> PestDetectionBatchResponse:
+    """Analyse (crop_type, image) jobs concurrently and queue every new result for the write-behind buffer.
+
+    An image is raw bytes, a base64 string, or an exception raised while reading it.
+    """
+    semaphore = asyncio.Semaphore(PEST_BATCH_CONCURRENCY)
+    
+    async def run(index: int, crop_type: Optional[str], image) -> Tuple[PestDetectionBatchItem, Optional[Dict]]:
+        if isinstance(image, Exception):
+            return PestDetectionBatchItem(index=index, error=str(image)), None
+        async with semaphore:
+            try:
+                if isinstance(image, bytes):
+                    image_hash = await hash_pest_image(image)
+                else:
+                    image_hash = await try_hash_image_base64(image)
+                response, response_dict = await diagnose_pest(crop_type, image_hash)
+                return PestDetectionBatchItem(index=index, result=response), response_dict
+            except HTTPException as e:
+                return PestDetectionBatchItem(index=index, error=str(e.detail)), None
+            except Exception as e:
+                logger.error(f"Error in batch pest detection item {index}: {str(e)}")
+                return PestDetectionBatchItem(index=index, error=f"Failed to analyze image: {str(e)}"), None
+    
+    outcomes = await asyncio.gather(*(run(index, crop_type, image) for index, (crop_type, image) in enumerate(jobs)))
+    
+    for _, response_dict in outcomes:
+        if response_dict:
+            await write_behind.write("pest_detection", response_dict)
+    
+    results = [item for item, _ in outcomes]
+    failed = sum(1 for item in results if item.error)
+    return PestDetectionBatchResponse(results=results, succeeded=len(results) - failed, failed=failed)
+
+@api_router.post("/pest-detection/batch", response_model=PestDetectionBatchResponse)
+async def detect_pest_batch(request: PestDetectionBatchRequest):
+    """Analyse many base64 images at once; results come back in input order"""
+    if not request.items:
+        raise HTTPException(status_code=400, detail="No images supplied")
+    if len(request.items) > PEST_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {PEST_BATCH_MAX_ITEMS} images per batch")
+    try:
+        return await run_pest_batch([base64_image_job(item.crop_type, item.image_base64) for item in request.items])
+        
+    except Exception as e:
+        logger.error(f"Error in batch pest detection: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to analyze images: {str(e)}")
+
+@api_router.post("/pest-detection/batch/upload", response_model=PestDetectionBatchResponse)
+async def detect_pest_batch_upload(request: Request):
+    """Analyse many photos sent as multipart/form-data (fields: files, crop_type)"""
+    content_length = request.headers.get("content-length")
+    max_body = (PEST_UPLOAD_MAX_BYTES + UPLOAD_CHUNK_SIZE) * PEST_BATCH_MAX_ITEMS
+    if content_length and content_length.isdigit() and int(content_length) > max_body:
+        raise HTTPException(status_code=413, detail="Batch upload is too large")
+    
+    request = limit_request_body(request, max_body, "Batch upload is too large")
+    form = await request.form(max_files=PEST_BATCH_MAX_ITEMS, max_fields=5)
+    try:
+        uploads = [upload for upload in form.getlist("files") if not isinstance(upload, str)]
+        if not uploads:
+            raise HTTPException(status_code=400, detail="No images supplied")
+        crop_type = form.get("crop_type") or None
+        
+        jobs = []
+        for upload in uploads:
+            try:
+                jobs.append((crop_type, await read_upload(upload, PEST_UPLOAD_MAX_BYTES)))
+            except HTTPException as e:
+                # An oversize file fails on its own without sinking the rest of the batch
+                jobs.append((crop_type, ValueError(e.detail)))
+    finally:
+        await form.close()
+    
+    try:
+        return await run_pest_batch(jobs)
+        
+    except Exception as e:
+        logger.error(f"Error in batch pest detection: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to analyze images: {str(e)}")
+
+def canonical_phone(phone: Optional[str]) -> Optional[str]:
+    """Reduce a phone number to its digits, dropping the +91 / leading-zero prefixes"""
+    if phone is None:
+        return None
+    digits = re.sub(r"\D", "", str(phone))
+    if len(digits) == 12 and digits.startswith("91"):
+        digits = digits[2:]
+    elif len(digits) == 11 and digits.startswith("0"):
+        digits = digits[1:]
+    return digits or None
+
+def build_farmer_profile(profile: FarmerProfileCreate) -> FarmerProfile:
+    farmer_obj = FarmerProfile(**profile.dict())
+    farmer_obj.phone = canonical_phone(farmer_obj.phone)
+    farmer_obj.primary_crops = canonical_crops(farmer_obj.primary_crops)
+    return farmer_obj
+
+@api_router.post("/farmer-profile", response_model=FarmerProfile)
+async def create_farmer_profile(profile: FarmerProfileCreate):
+    try:
+        farmer_obj = build_farmer_profile(profile)
+        
+        farmer_dict = farmer_obj.dict()
         await db.farmer_profiles.insert_one(farmer_dict)
         
         return farmer_obj
         
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="A farmer with this phone number already exists")
     except Exception as e:
         logger.error(f"Error creating farmer profile: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create profile: {str(e)}")
 
+FARMER_IMPORT_BATCH_SIZE = int(os.environ.get('FARMER_IMPORT_BATCH_SIZE', '1000'))
+FARMER_IMPORT_MAX_LINE_BYTES = 64 * 1024
+FARMER_IMPORT_MAX_ERRORS = 100  # rejected rows echoed back in the summary
+FARMER_IMPORT_FORMATS = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/json": "ndjson",
+}
+
+async def iter_body_lines(request: Request):
+    """Yield (line_number, text) for each line of the request body as it arrives.
+
+    Only the current partial line is buffered. A line longer than FARMER_IMPORT_MAX_LINE_BYTES
+    is yielded as None and the rest of it is discarded.
+    """
+    # Split on raw bytes: b"\n" never occurs inside a multi-byte UTF-8 character
+    pending = b""
+    line_number = 0
+    overlong = False
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            line_number += 1
+            too_long = overlong or len(line) > FARMER_IMPORT_MAX_LINE_BYTES
+            yield line_number, None if too_long else decode_body_line(line, line_number)
+            overlong = False
+        if len(pending) > FARMER_IMPORT_MAX_LINE_BYTES:
+            pending = b""
+            overlong = True
+    if pending or overlong:
+        line_number += 1
+        too_long = overlong or len(pending) > FARMER_IMPORT_MAX_LINE_BYTES
+        yield line_number, None if too_long else decode_body_line(pending, line_number)
+
+def decode_body_line(line: bytes, line_number: int) -> str:
+    return line.decode("utf-8-sig" if line_number == 1 else "utf-8").rstrip("\r")
+
+# As in the csv module, a quote opens a quoted field only at the start of a field; "" inside one is an escaped quote
+CSV_QUOTED_FIELD_START = re.compile(r'(?:^|,)"')
+CSV_QUOTED_FIELD_END = re.compile(r'(?:[^"]|"")*"(?!")')
+
+def csv_quote_open(line: str, in_quotes: bool) -> bool:
+    """Whether a quoted field is still open at the end of line, given whether one was open at its start"""
+    position = 0
+    while True:
+        if in_quotes:
+            end = CSV_QUOTED_FIELD_END.match(line, position)
+            if not end:
+                return True
+            position, in_quotes = end.end(), False
+        else:
+            start = CSV_QUOTED_FIELD_START.search(line, position)
+            if not start:
+                return False
+            position, in_quotes = start.end(), True
+
+async def iter_csv_records(lines):
+    """Group body lines into CSV records, joining lines while a quoted field is still open.
+
+    A record still open at the end of the body is yielded as it is, for the strict parser to reject.
+    """
+    record: List[str] = []
+    first_row = None
+    in_quotes = False
+    size = 0
+    async for row, line in lines:
+        if line is None:
+            yield row, None
+            record, in_quotes, size = [], False, 0
+            continue
+        if not record:
+            first_row = row
+        record.append(line)
+        in_quotes = csv_quote_open(line, in_quotes)
+        size += len(line.encode("utf-8"))
+        if not in_quotes:
+            yield first_row, "\n".join(record)
+            record, size = [], 0
+        elif size > FARMER_IMPORT_MAX_LINE_BYTES:
+            yield first_row, None
+            record, in_quotes, size = [], False, 0
+    if record:
+        yield first_row, "\n".join(record)
+
+def split_crops(value) -> List[str]:
+    if isinstance(value, str):
+        return [crop.strip() for crop in re.split(r"[;|,]", value) if crop.strip()]
+    return value
+
+class FarmerImportSummary:
+    """Running totals for one import; only the first few rejections are kept"""
+    
+    def __init__(self):
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors: List[Dict] = []
+    
+    def reject(self, row: int, error: str):
+        self.rejected += 1
+        if len(self.errors) < FARMER_IMPORT_MAX_ERRORS:
+            self.errors.append({"row": row, "error": error})
+    
+    def as_dict(self) -> Dict:
+        return {
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+phone_index_checked = False
+
+async def phone_index_ready() -> bool:
+    """Whether the unique phone index that duplicate detection relies on exists; checked until it does"""
+    global phone_index_checked
+    if not phone_index_checked:
+        indexes = await db.farmer_profiles.index_information()
+        phone_index_checked = any(
+            list(index["key"]) == [("phone", ASCENDING)] and index.get("unique") for index in indexes.values()
+        )
+    return phone_index_checked
+
+async def insert_farmer_batch(documents: List[Dict], rows: List[int], summary: FarmerImportSummary):
+    """Unordered insert_many; duplicate phones are counted, any other write error rejects its row"""
+    try:
+        result = await db.farmer_profiles.insert_many(documents, ordered=False)
+        summary.accepted += len(result.inserted_ids)
+    except BulkWriteError as e:
+        details = e.details
+        summary.accepted += details.get("nInserted", 0)
+        for error in details.get("writeErrors", []):
+            if error.get("code") == 11000:
+                summary.duplicates += 1
+            else:
+                summary.reject(rows[error["index"]], error.get("errmsg", "Write failed"))
+
+@api_router.post("/farmer-profiles/import")
+async def import_farmer_profiles(request: Request, format: Optional[str] = Query(None, pattern="^(csv|ndjson)$")):
+    """Bulk-register farmers from a streamed CSV (with header row) or NDJSON body.
+
+    Rows are validated as they arrive and written in unordered batches of FARMER_IMPORT_BATCH_SIZE,
+    so memory use does not grow with the file. Phones already on record count as duplicates.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    body_format = format or FARMER_IMPORT_FORMATS.get(content_type)
+    if not body_format:
+        raise HTTPException(status_code=415, detail="Send text/csv or application/x-ndjson, or pass ?format=")
+    
+    if not await phone_index_ready():
+        raise HTTPException(status_code=503, detail="The unique phone index is missing, so duplicates cannot be detected; check the startup logs")
+    
+    summary = FarmerImportSummary()
+    documents: List[Dict] = []
+    rows: List[int] = []
+    header = None
+    lines = iter_body_lines(request)
+    try:
+        async for row, line in iter_csv_records(lines) if body_format == "csv" else lines:
+            if line is None:
+                summary.reject(row, f"Line exceeds {FARMER_IMPORT_MAX_LINE_BYTES} bytes")
+                continue
+            if not line.strip():
+                continue
+            try:
+                if body_format == "csv":
+                    values = next(csv.reader([line], strict=True))
+                    if header is None:
+                        header = [normalize_text(column).replace(" ", "_") for column in values]
+                        continue
+                    record = {column: value.strip() for column, value in zip(header, values) if value.strip()}
+                else:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError("Expected a JSON object")
+                    if isinstance(record.get("phone"), int):
+                        record["phone"] = str(record["phone"])
+                if "primary_crops" in record:
+                    record["primary_crops"] = split_crops(record["primary_crops"])
+                farmer_obj = build_farmer_profile(FarmerProfileCreate(**record))
+            except ValidationError as e:
+                summary.reject(row, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+                continue
+            except (ValueError, csv.Error) as e:
+                summary.reject(row, str(e))
+                continue
+            
+            documents.append(farmer_obj.dict())
+            rows.append(row)
+            if len(documents) >= FARMER_IMPORT_BATCH_SIZE:
+                await insert_farmer_batch(documents, rows, summary)
+                documents, rows = [], []
+        
+        if documents:
+            await insert_farmer_batch(documents, rows, summary)
+        return summary.as_dict()
+        
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Body is not valid UTF-8")
+    except Exception as e:
+        logger.error(f"Error importing farmer profiles: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to import profiles: {str(e)}")
+
 @api_router.get("/farmer-profiles", response_model=List[FarmerProfile])
-async def get_farmer_profiles():
+async def get_farmer_profiles(
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    after: Optional[str] = None
+):
+    """List farmer profiles newest first; the next page's cursor is returned in X-Next-Cursor"""
+    after_key = decode_cursor(after) if after else None
     try:
-        profiles = await db.farmer_profiles.find().to_list(1000)
-        for profile in profiles:
-            if isinstance(profile.get('created_at'), str):
-                profile['created_at'] = datetime.fromisoformat(profile['created_at'])
-        return [FarmerProfile(**profile) for profile in profiles]
+        profiles, next_cursor = await fetch_page(
+            db.farmer_profiles, {}, FARMER_PROFILES_SORT, limit, after_key,
+            model_projection(FarmerProfile)
+        )
+        return json_response(profiles, next_cursor)
         
     except Exception as e:
         logger.error(f"Error getting farmer profiles: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get profiles: {str(e)}")
 
 @api_router.get("/advice-history", response_model=List[CropAdviceResponse])
-async def get_advice_history():
+async def get_advice_history(
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    after: Optional[str] = None
+):
+    """List past advice newest first; the next page's cursor is returned in X-Next-Cursor"""
+    after_key = decode_cursor(after) if after else None
     try:
-        advice_list = await db.crop_advice.find().sort("timestamp", -1).to_list(100)
-        for advice in advice_list:
-            if isinstance(advice.get('timestamp'), str):
-                advice['timestamp'] = datetime.fromisoformat(advice['timestamp'])
-        return [CropAdviceResponse(**advice) for advice in advice_list]
+        advice_list, next_cursor = await fetch_page(
+            db.crop_advice, {}, ADVICE_HISTORY_SORT, limit, after_key,
+            model_projection(CropAdviceResponse)
+        )
+        return json_response(advice_list, next_cursor)
         
     except Exception as e:
         logger.error(f"Error getting advice history: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get advice history: {str(e)}")
 
-# NEW CROP CALENDAR & MARKETPLACE ENDPOINTS
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
 
-@api_router.get("/crop-recommendations/{farmer_id}")
-async def get_crop_recommendations(farmer_id: str):
-    """Get AI-driven crop recommendations based on market demand and conditions"""
+# Exportable history: url name -> (collection, time field, has farmer_id)
+EXPORT_COLLECTIONS = {
+    "crop-advice": ("crop_advice", "timestamp", True),
+    "pest-detection": ("pest_detection", "timestamp", False),
+    "market-alerts": ("market_alerts", "created_at", True),
+}
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+async def iter_ndjson(cursor, compress: bool):
+    """Encode a cursor as NDJSON one batch at a time, optionally as a gzip stream"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    lines = []
     try:
-        llm_chat = get_llm_chat()
-        
-        # Get farmer profile
-        farmer = await db.farmer_profiles.find_one({"id": farmer_id})
-        if not farmer:
-            raise HTTPException(status_code=404, detail="Farmer not found")
-        
-        location = farmer.get('location', 'Punjab')
-        farm_size = farmer.get('farm_size', 'Medium')
+        async for document in cursor:
+            lines.append(dump_json(document))
+            if len(lines) >= EXPORT_BATCH_SIZE:
+                chunk = b"\n".join(lines) + b"\n"
+                lines = []
+                yield compressor.compress(chunk) if compressor else chunk
+        chunk = b"\n".join(lines) + b"\n" if lines else b""
+        if compressor:
+            yield compressor.compress(chunk) + compressor.flush()
+        elif chunk:
+            yield chunk
+    except Exception as e:
+        # Headers are already sent, so a failure can only cut the stream short
+        logger.error(f"Error streaming export: {str(e)}")
+        raise
+    finally:
+        await cursor.close()
+
+@api_router.get("/export/{dataset}")
+async def export_history(
+    dataset: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    farmer_id: Optional[str] = None,
+    compress: bool = Query(False, alias="gzip")
+):
+    """Stream crop-advice, pest-detection or market-alerts history as NDJSON, oldest first.
+
+    since/until bound the record time (until is exclusive). gzip=true returns a .ndjson.gz download.
+    """
+    if dataset not in EXPORT_COLLECTIONS:
+        raise HTTPException(status_code=404, detail=f"Unknown export '{dataset}'")
+    collection_name, time_field, has_farmer = EXPORT_COLLECTIONS[dataset]
+    since, until = as_utc(since), as_utc(until)
+    if since and until and since >= until:
+        raise HTTPException(status_code=400, detail="since must be earlier than until")
+    if farmer_id and not has_farmer:
+        raise HTTPException(status_code=400, detail=f"{dataset} records are not linked to a farmer")
+    
+    query = {}
+    if farmer_id:
+        query["farmer_id"] = farmer_id
+    if since or until:
+        query[time_field] = {key: value for key, value in (("$gte", since), ("$lt", until)) if value}
+    
+    cursor = (
+        db[collection_name].find(query, {"_id": 0})
+        .sort(time_field, ASCENDING)
+        .batch_size(EXPORT_BATCH_SIZE)
+    )
+    filename = f"{collection_name}.ndjson" + (".gz" if compress else "")
+    return StreamingResponse(
+        iter_ndjson(cursor, compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def component_stats() -> Dict[str, Dict]:
+    return {
+        "crop_advice": advice_cache.stats(),
+        "llm_single_flight": llm_single_flight.stats(),
+        "llm_pool": llm_pool.stats(),
+        "pest_detection": pest_hash_index.stats(),
+        "recommendation_analyses": recommendation_analyses.stats(),
+        "market_alerts": alert_engine.stats(),
+        "write_behind": write_behind.stats(),
+    }
+
+class ComponentStatsCollector:
+    """Publishes the counters each component already keeps, read at scrape time rather than on the hot path"""
+
+    def collect(self):
+        hit_ratio = GaugeMetricFamily("smartcrop_cache_hit_ratio", "Cache hit ratio since startup", labels=["cache"])
+        lookups = CounterMetricFamily("smartcrop_cache_lookups", "Cache lookups by result", labels=["cache", "result"])
+        component = GaugeMetricFamily("smartcrop_component", "Sizes, in-flight counts and counters of internal components", labels=["component", "stat"])
+        for name, stats in component_stats().items():
+            if "hit_ratio" in stats:
+                hit_ratio.add_metric([name], stats["hit_ratio"])
+                lookups.add_metric([name, "hit"], stats["hits"])
+                lookups.add_metric([name, "miss"], stats["misses"])
+            for stat, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and stat not in ("hit_ratio", "hits", "misses"):
+                    component.add_metric([name, stat], value)
+        yield hit_ratio
+        yield lookups
+        yield component
+
+metrics_registry.register(ComponentStatsCollector())
+
+@api_router.get("/cache-stats")
+async def get_cache_stats():
+    """Get hit/miss counters for the response caches"""
+    return component_stats()
+
+@api_router.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: route latency, MongoDB and LLM timings, in-flight counts and cache hit ratios"""
+    return Response(generate_latest(metrics_registry), media_type=CONTENT_TYPE_LATEST)
+
+# NEW CROP CALENDAR & MARKETPLACE ENDPOINTS
+
+RECOMMENDATION_JOB_RETENTION = int(os.environ.get('RECOMMENDATION_JOB_RETENTION', '1000'))
+SSE_KEEPALIVE_SECONDS = 15
+
+def current_season(now: Optional[datetime] = None) -> str:
+    """Cropping season label such as '2025-kharif'; rabi runs across the new year"""
+    now = now or datetime.now(timezone.utc)
+    if 6 <= now.month <= 10:
+        return f"{now.year}-kharif"
+    if now.month >= 11:
+        return f"{now.year}-rabi"
+    if now.month <= 3:
+        return f"{now.year - 1}-rabi"
+    return f"{now.year}-zaid"
+
+def profile_fingerprint(farmer: Dict) -> str:
+    """Hash of the profile fields, so any profile change invalidates cached analyses"""
+    fields = {field: farmer.get(field) for field in FarmerProfileCreate.model_fields}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class RecommendationJob:
+    def __init__(self, farmer_id: str):
+        self.id = str(uuid.uuid4())
+        self.farmer_id = farmer_id
+        self.status = "pending"  # "pending", "running", "done", "failed"
+        self.ai_analysis = None
+        self.error = None
+        self.created_at = datetime.now(timezone.utc)
+        self.completed_at = None
+        self.done = asyncio.Event()
+        self.task = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "farmer_id": self.farmer_id,
+            "status": self.status,
+            "ai_analysis": self.ai_analysis,
+            "error": self.error,
+            "created_at": self.created_at,
+            "completed_at": self.completed_at,
+        }
+
+class RecommendationAnalyses:
+    """AI analyses for crop recommendations, run as background jobs and cached per farmer.
+
+    A cached analysis stays valid until the farmer's profile fingerprint or the
+    cropping season changes.
+    """
+
+    def __init__(self, collection, retention: int):
+        self.collection = collection
+        self.retention = retention
+        self._jobs = OrderedDict()  # job_id -> RecommendationJob
+        self._active = {}  # (farmer_id, fingerprint, season) -> RecommendationJob
+        self.hits = 0
+        self.misses = 0
+
+    async def cached(self, farmer_id: str, fingerprint: str, season: str) -> Optional[str]:
+        doc = await self.collection.find_one(
+            {"farmer_id": farmer_id, "fingerprint": fingerprint, "season": season},
+            {"_id": 0, "ai_analysis": 1}
+        )
+        if doc:
+            self.hits += 1
+            return doc["ai_analysis"]
+        self.misses += 1
+        return None
+
+    def start(self, farmer: Dict, fingerprint: str, season: str) -> RecommendationJob:
+        farmer_id = farmer["id"]
+        key = (farmer_id, fingerprint, season)
+        job = self._active.get(key)
+        if job:
+            return job
         
-        query = f"""
+        job = RecommendationJob(farmer_id)
+        self._active[key] = job
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.retention:
+            self._jobs.popitem(last=False)
+        job.task = asyncio.ensure_future(self._run(job, key, farmer))
+        return job
+
+    async def _run(self, job: RecommendationJob, key: Tuple[str, str, str], farmer: Dict):
+        farmer_id, fingerprint, season = key
+        job.status = "running"
+        try:
+            try:
+                analysis = await ask_llm(build_recommendation_prompt(farmer))
+            except LlmUnavailable as e:
+                # Not cached, so the next request tries the LLM again
+                logger.warning(f"Serving fallback recommendation analysis: {str(e)}")
+                job.ai_analysis = fallback_recommendation_analysis(farmer)
+                job.status = "done"
+                return
+            await self.collection.update_one(
+                {"farmer_id": farmer_id},
+                {"$set": {
+                    "farmer_id": farmer_id,
+                    "fingerprint": fingerprint,
+                    "season": season,
+                    "ai_analysis": analysis,
+                    "generated_at": datetime.now(timezone.utc),
+                }},
+                upsert=True
+            )
+            job.ai_analysis = analysis
+            job.status = "done"
+        except Exception as e:
+            logger.error(f"Error generating recommendation analysis: {str(e)}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.completed_at = datetime.now(timezone.utc)
+            self._active.pop(key, None)
+            job.done.set()
+
+    def get(self, job_id: str) -> Optional[RecommendationJob]:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "active_jobs": len(self._active),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+recommendation_analyses = RecommendationAnalyses(db.recommendation_analyses, RECOMMENDATION_JOB_RETENTION)
+
+def build_recommendation_prompt(farmer: Dict) -> str:
+    location = farmer.get('location', 'Punjab')
+    farm_size = farmer.get('farm_size', 'Medium')
+    
+    return f"""
         Generate crop recommendations for a farmer in {location} with {farm_size} farm size.
         Consider current market demand, seasonal timing, and profit potential.
         Focus on Punjab/Haryana suitable crops: Rice, Wheat, Corn, Cotton, Sugarcane, Mustard.
@@ -388,9 +3107,22 @@ async def get_crop_recommendations(farmer_id: str):
         4. Optimal sowing and harvest windows
         5. Key benefits and risks for each crop
         """
+
+@api_router.get("/crop-recommendations/{farmer_id}")
+async def get_crop_recommendations(farmer_id: str):
+    """Get crop recommendations right away; the AI analysis is cached or produced by a background job"""
+    try:
+        # Get farmer profile
+        farmer = await db.farmer_profiles.find_one({"id": farmer_id})
+        if not farmer:
+            raise HTTPException(status_code=404, detail="Farmer not found")
         
-        user_message = UserMessage(text=query)
-        ai_response = await llm_chat.send_message(user_message)
+        fingerprint = profile_fingerprint(farmer)
+        season = current_season()
+        ai_response = await recommendation_analyses.cached(farmer_id, fingerprint, season)
+        job = None
+        if ai_response is None:
+            job = recommendation_analyses.start(farmer, fingerprint, season)
         
         # Generate structured recommendations
         recommendations = []
@@ -420,13 +3152,103 @@ async def get_crop_recommendations(farmer_id: str):
             "farmer_id": farmer_id,
             "recommendations": recommendations,
             "ai_analysis": ai_response,
+            "analysis_status": job.status if job else "done",
+            "analysis_job_id": job.id if job else None,
             "generated_at": datetime.now(timezone.utc)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting crop recommendations: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/crop-recommendations/jobs/{job_id}")
+async def get_recommendation_job(job_id: str):
+    """Poll a background AI analysis job"""
+    job = recommendation_analyses.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@api_router.get("/crop-recommendations/jobs/{job_id}/events")
+async def stream_recommendation_job(job_id: str):
+    """Subscribe to a background AI analysis job as server-sent events"""
+    job = recommendation_analyses.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def events():
+        yield sse_event("status", job.to_dict())
+        while not job.done.is_set():
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout=SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+        yield sse_event("done", job.to_dict())
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+CROP_CALENDAR_BULK_MAX_ITEMS = int(os.environ.get('CROP_CALENDAR_BULK_MAX_ITEMS', '5000'))
+
+class CropCalendarPlanItem(BaseModel):
+    farmer_id: str
+    crop_name: str
+
+class CropCalendarBulkRequest(BaseModel):
+    items: List[CropCalendarPlanItem]
+
+def build_calendar_entry(farmer_id: str, crop_name: str, calendar_data: Dict) -> CropCalendarEntry:
+    return CropCalendarEntry(
+        crop_name=crop_name,
+        farmer_id=farmer_id,
+        sowing_date=calendar_data["sowing_date"],
+        harvesting_date=calendar_data["harvest_date"],
+        expected_yield=calendar_data["expected_yield"],
+        market_demand_score=calendar_data["market_demand_score"],
+        recommended_selling_date=calendar_data["selling_date"],
+        estimated_price=calendar_data["estimated_price"],
+        weather_risk=calendar_data["weather_risk"]
+    )
+
+@api_router.post("/crop-calendar/bulk")
+async def create_crop_calendars_bulk(request: CropCalendarBulkRequest):
+    """Plan calendars for many farmer x crop pairs in one pass and store them with one insert_many"""
+    if len(request.items) > CROP_CALENDAR_BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {CROP_CALENDAR_BULK_MAX_ITEMS} items per request")
+    try:
+        accepted = []
+        rejected = []
+        for index, item in enumerate(request.items):
+            crop_name = canonical_crop(item.crop_name)
+            if crop_name in PUNJAB_CROPS_DATA:
+                accepted.append((item.farmer_id, crop_name))
+            else:
+                rejected.append({"index": index, "farmer_id": item.farmer_id, "crop_name": item.crop_name,
+                                 "error": "Crop not supported"})
+        
+        plans = calendar_planner.plan([crop_name for _, crop_name in accepted], price_ratios=current_price_ratios())
+        entries = [
+            build_calendar_entry(farmer_id, crop_name, plan).dict()
+            for (farmer_id, crop_name), plan in zip(accepted, plans)
+        ]
+        if entries:
+            # insert_many adds _id to each document, so hand it copies
+            await db.crop_calendar.insert_many([dict(entry) for entry in entries], ordered=False)
+        
+        return Response(
+            dump_json({"created": len(entries), "entries": entries, "rejected": rejected}),
+            media_type="application/json"
+        )
+        
+    except Exception as e:
+        logger.error(f"Error creating crop calendars: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @api_router.post("/crop-calendar")
 async def create_crop_calendar(farmer_id: str, crop_name: str):
     """Create optimal crop calendar for farmer"""
@@ -435,29 +3257,10 @@ async def create_crop_calendar(farmer_id: str, crop_name: str):
         if not calendar_data:
             raise HTTPException(status_code=400, detail="Crop not supported")
         
-        # Calculate market demand score and weather risk
-        market_demand_score = random.uniform(0.6, 0.95)
-        weather_risk = random.choice(["Low", "Medium", "High"])
-        
-        calendar_entry = CropCalendarEntry(
-            crop_name=crop_name,
-            farmer_id=farmer_id,
-            sowing_date=calendar_data["sowing_date"],
-            harvesting_date=calendar_data["harvest_date"],
-            expected_yield=calendar_data["expected_yield"],
-            market_demand_score=market_demand_score,
-            recommended_selling_date=calendar_data["harvest_date"] + timedelta(days=random.randint(7, 30)),
-            estimated_price=calendar_data["estimated_price"],
-            weather_risk=weather_risk
-        )
+        calendar_entry = build_calendar_entry(farmer_id, crop_name, calendar_data)
         
         # Save to database
         calendar_dict = calendar_entry.dict()
-        calendar_dict['sowing_date'] = calendar_dict['sowing_date'].isoformat()
-        calendar_dict['harvesting_date'] = calendar_dict['harvesting_date'].isoformat()
-        calendar_dict['recommended_selling_date'] = calendar_dict['recommended_selling_date'].isoformat()
-        calendar_dict['created_at'] = calendar_dict['created_at'].isoformat()
-        
         await db.crop_calendar.insert_one(calendar_dict)
         
         return calendar_entry
@@ -467,130 +3270,240 @@ async def create_crop_calendar(farmer_id: str, crop_name: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/crop-calendar/{farmer_id}")
-async def get_farmer_calendar(farmer_id: str):
-    """Get farmer's crop calendar"""
+async def get_farmer_calendar(
+    request: Request,
+    farmer_id: str,
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    after: Optional[str] = None
+):
+    """Get farmer's crop calendar in sowing order; the next page's cursor is returned in X-Next-Cursor"""
+    after_key = decode_cursor(after) if after else None
     try:
-        calendar_entries = await db.crop_calendar.find({"farmer_id": farmer_id}).to_list(100)
-        
-        for entry in calendar_entries:
-            for date_field in ['sowing_date', 'harvesting_date', 'recommended_selling_date', 'created_at']:
-                if isinstance(entry.get(date_field), str):
-                    entry[date_field] = datetime.fromisoformat(entry[date_field])
-        
-        return [CropCalendarEntry(**entry) for entry in calendar_entries]
+        calendar_entries, next_cursor = await fetch_page(
+            db.crop_calendar, {"farmer_id": farmer_id}, CROP_CALENDAR_SORT, limit, after_key,
+            model_projection(CropCalendarEntry)
+        )
+        # No version is stored per calendar, so the ETag is a hash of the page; a match still saves the transfer
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+        return conditional_json_response(request, EncodedJson(calendar_entries), headers)
         
     except Exception as e:
         logger.error(f"Error getting crop calendar: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/market-prices")
-async def get_market_prices():
-    """Get current market prices from mandis"""
+@api_router.get("/market-prices", response_model=List[MarketPrice])
+async def get_market_prices(request: Request, crop: Optional[str] = None, mandi: Optional[str] = None):
+    """Get current market prices from mandis; unchanged prices are answered with 304 via ETag"""
     try:
-        # Generate fresh market data for demo
-        market_prices = generate_market_prices()
-        
-        # Save to database for consistency
-        for price in market_prices:
-            price_dict = price.dict()
-            price_dict['last_updated'] = price_dict['last_updated'].isoformat()
-            
-            # Update existing or insert new
-            await db.market_prices.update_one(
-                {"crop_name": price.crop_name, "mandi_name": price.mandi_name},
-                {"$set": price_dict},
-                upsert=True
-            )
-        
-        return market_prices
+        # Served from the in-memory snapshot kept fresh by market_price_refresher
+        snapshot = await get_market_snapshot()
+        return conditional_json_response(request, snapshot.encoded(crop, mandi))
         
     except Exception as e:
         logger.error(f"Error getting market prices: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/market-alerts/{farmer_id}")
-async def get_market_alerts(farmer_id: str):
-    """Get personalized market alerts for farmer"""
+MARKET_HISTORY_MAX_POINTS = 500  # per mandi series
+HISTORY_INTERVAL_SECONDS = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+
+@api_router.get("/market-prices/history")
+async def get_market_price_history(
+    crop: str,
+    mandi: Optional[str] = None,
+    interval: str = Query("day", pattern="^(hour|day|week)$"),
+    days: int = Query(90, ge=1, le=MARKET_HISTORY_RETENTION_DAYS)
+):
+    """Get OHLC price history per mandi, downsampled server-side to hourly, daily or weekly bars"""
+    crop_name = canonical_crop(crop)
+    if crop_name not in PUNJAB_CROPS_DATA:
+        raise HTTPException(status_code=400, detail="Crop not supported")
+    if days * 86400 / HISTORY_INTERVAL_SECONDS[interval] > MARKET_HISTORY_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"At most {MARKET_HISTORY_MAX_POINTS} points per series; use a coarser interval")
+    
+    match = {"meta.crop_name": crop_name, "timestamp": {"$gte": datetime.now(timezone.utc) - timedelta(days=days)}}
+    if mandi:
+        location = canonical_location(mandi)
+        mandi_names = [name for name in PUNJAB_MANDIS if name.split()[0] == location]
+        if not mandi_names:
+            raise HTTPException(status_code=400, detail="Mandi not supported")
+        match["meta.mandi_name"] = mandi_names[0]
+    
     try:
-        # Get farmer's crops
-        farmer = await db.farmer_profiles.find_one({"id": farmer_id})
-        if not farmer:
-            raise HTTPException(status_code=404, detail="Farmer not found")
-        
-        farmer_crops = farmer.get('primary_crops', [])
-        alerts = []
-        
-        # Generate alerts for farmer's crops
-        for crop in farmer_crops:
-            if crop in PUNJAB_CROPS_DATA:
-                # Price spike alert
-                mandi = random.choice(PUNJAB_MANDIS)
-                price = PUNJAB_CROPS_DATA[crop]["base_price"] * random.uniform(1.1, 1.4)
-                
-                alert = MarketAlert(
-                    farmer_id=farmer_id,
-                    crop_name=crop,
-                    alert_type="price_spike",
-                    message=f"Price spike for {crop} at {mandi}! Current rate: ₹{price:.2f}/quintal",
-                    priority="high",
-                    mandi_name=mandi,
-                    price_offered=price,
-                    valid_until=datetime.now(timezone.utc) + timedelta(days=3)
-                )
-                alerts.append(alert)
-        
-        # Add high demand alert
-        if farmer_crops:
-            crop = random.choice(farmer_crops)
-            mandi = random.choice(PUNJAB_MANDIS)
-            alert = MarketAlert(
-                farmer_id=farmer_id,
-                crop_name=crop,
-                alert_type="high_demand",
-                message=f"High demand for {crop} expected next month. Consider early harvest planning.",
-                priority="medium",
-                mandi_name=mandi,
-                price_offered=PUNJAB_CROPS_DATA.get(crop, {}).get("base_price", 2000) * 1.15,
-                valid_until=datetime.now(timezone.utc) + timedelta(days=30)
-            )
-            alerts.append(alert)
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": {
+                    "mandi_name": "$meta.mandi_name",
+                    "timestamp": {"$dateTrunc": {"date": "$timestamp", "unit": interval}},
+                },
+                "open": {"$first": "$price"},
+                "high": {"$max": "$price"},
+                "low": {"$min": "$price"},
+                "close": {"$last": "$price"},
+            }},
+            {"$sort": {"_id.mandi_name": 1, "_id.timestamp": 1}},
+        ]
+        series = OrderedDict()
+        async for bar in db[MARKET_PRICE_TICKS].aggregate(pipeline):
+            key = bar.pop("_id")
+            bar["timestamp"] = key["timestamp"]
+            series.setdefault(key["mandi_name"], []).append(bar)
         
-        # Save alerts to database
-        for alert in alerts:
-            alert_dict = alert.dict()
-            alert_dict['valid_until'] = alert_dict['valid_until'].isoformat()
-            alert_dict['created_at'] = alert_dict['created_at'].isoformat()
-            await db.market_alerts.insert_one(alert_dict)
+        return {
+            "crop_name": crop_name,
+            "interval": interval,
+            "series": [{"mandi_name": name, "points": points} for name, points in series.items()],
+        }
         
-        return alerts
+    except Exception as e:
+        logger.error(f"Error getting market price history: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+MARKET_ALERTS_DEFAULT_WINDOW = timedelta(days=30)  # history returned when no since is given
+
+def parse_event_id(value: Optional[str]) -> Optional[datetime]:
+    """Alert events carry their created_at as the SSE id; anything else is ignored"""
+    try:
+        return as_utc(datetime.fromisoformat(value)) if value else None
+    except ValueError:
+        return None
+
+async def find_market_alerts(farmer_id: str, since: datetime) -> List[Dict]:
+    return await db.market_alerts.find(
+        {"farmer_id": farmer_id, "created_at": {"$gt": since}}, model_projection(MarketAlert)
+    ).sort("created_at", DESCENDING).limit(PAGE_MAX_LIMIT).to_list(PAGE_MAX_LIMIT)
+
+async def ensure_farmer(farmer_id: str):
+    if not await db.farmer_profiles.find_one({"id": farmer_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Farmer not found")
+
+@api_router.get("/market-alerts/{farmer_id}", response_model=List[MarketAlert])
+async def get_market_alerts(farmer_id: str, since: Optional[datetime] = None):
+    """Get the farmer's market alerts newest first; since (exclusive) returns only newer ones"""
+    try:
+        await ensure_farmer(farmer_id)
+        since = as_utc(since) or datetime.now(timezone.utc) - MARKET_ALERTS_DEFAULT_WINDOW
+        return json_response(await find_market_alerts(farmer_id, since))
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting market alerts: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/demand-forecast")
-async def get_demand_forecast():
-    """Get market demand forecast for major crops"""
+@api_router.get("/market-alerts/{farmer_id}/events")
+async def stream_market_alerts(farmer_id: str, request: Request, since: Optional[datetime] = None):
+    """Subscribe to a farmer's new market alerts as server-sent events.
+
+    Alerts created after since (or the Last-Event-ID a reconnecting EventSource sends) are replayed first.
+    """
+    await ensure_farmer(farmer_id)
+    since = as_utc(since) or parse_event_id(request.headers.get("last-event-id"))
+    # Subscribe before replaying so nothing created in between is missed
+    queue = alert_broker.subscribe(farmer_id)
+    
+    def alert_event(alert: Dict) -> str:
+        return sse_event("alert", alert, _json_default(alert["created_at"]))
+    
+    async def events():
+        try:
+            replayed = set()
+            if since:
+                for alert in reversed(await find_market_alerts(farmer_id, since)):
+                    replayed.add(alert["id"])
+                    yield alert_event(alert)
+            while True:
+                try:
+                    alert = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if alert.id not in replayed:
+                    yield alert_event(alert.dict())
+        finally:
+            alert_broker.unsubscribe(farmer_id, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+SYNC_OVERLAP_SECONDS = int(os.environ.get('SYNC_OVERLAP_SECONDS', '30'))
+SYNC_MAX_ALERTS = PAGE_MAX_LIMIT  # per response; the rest follow with has_more
+
+def decode_sync_token(token: str) -> Tuple[datetime, Optional[List]]:
+    """A token is [synced_at], or [synced_at, created_at, id] of the last alert sent when more remain"""
+    values = decode_cursor(token)
+    if len(values) not in (1, 3) or not all(isinstance(value, datetime) for value in values[:2]):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    alerts_after = [as_utc(values[1]), values[2]] if len(values) == 3 else None
+    return as_utc(values[0]), alerts_after
+
+@api_router.get("/sync/{farmer_id}")
+async def sync_farmer(request: Request, farmer_id: str, since: Optional[str] = None):
+    """Calendar entries, alerts and market prices changed since the client's sync token, in one response.
+
+    Without since, the full state is returned (alerts from the default window). Pass the returned
+    token back as since on the next sync. Calendar entries and alerts are insert-only, so their
+    created_at is their change time; price rows are rewritten on every refresh with last_updated.
+    Changes written in the SYNC_OVERLAP_SECONDS before the token are sent again, because their
+    timestamps are taken before they are committed; clients upsert rows by id.
+
+    Alerts come oldest first, at most SYNC_MAX_ALERTS at a time. When more remain, has_more is
+    true and the token resumes right after the last alert sent, so none are skipped.
+    """
+    synced_at = datetime.now(timezone.utc)
+    changed_after = alerts_after = None
+    if since:
+        checkpoint, alerts_after = decode_sync_token(since)
+        changed_after = checkpoint - timedelta(seconds=SYNC_OVERLAP_SECONDS)
     try:
-        forecasts = []
-        
-        for crop_name in PUNJAB_CROPS_DATA.keys():
-            forecast = DemandForecast(
-                crop_name=crop_name,
-                current_demand=random.choice(["High", "Medium", "Low"]),
-                forecast_3_months=random.choice(["Increasing", "Stable", "Decreasing"]),
-                forecast_6_months=random.choice(["Strong Growth", "Stable", "Decline Expected"]),
-                price_trend=random.choice(["Upward", "Stable", "Volatile"]),
-                market_factors=[
-                    "Export demand increasing",
-                    "Government procurement policy",
-                    "Weather conditions favorable",
-                    "Processing industry expansion"
-                ]
-            )
-            forecasts.append(forecast)
+        await ensure_farmer(farmer_id)
+        calendar_query = {"farmer_id": farmer_id}
+        price_query = {}
+        if changed_after:
+            calendar_query["created_at"] = {"$gt": changed_after}
+            price_query["last_updated"] = {"$gt": changed_after}
+        if alerts_after:
+            alert_query = keyset_query({"farmer_id": farmer_id}, SYNC_ALERTS_SORT, alerts_after)
+        else:
+            alert_query = {"farmer_id": farmer_id, "created_at": {"$gt": changed_after or synced_at - MARKET_ALERTS_DEFAULT_WINDOW}}
+        calendar_entries, alerts, market_prices = await asyncio.gather(
+            db.crop_calendar.find(calendar_query, model_projection(CropCalendarEntry))
+            .sort(CROP_CALENDAR_SORT).to_list(None),
+            db.market_alerts.find(alert_query, model_projection(MarketAlert))
+            .sort(SYNC_ALERTS_SORT).limit(SYNC_MAX_ALERTS + 1).to_list(SYNC_MAX_ALERTS + 1),
+            db.market_prices.find(price_query, model_projection(MarketPrice)).sort(SYNC_PRICES_SORT).to_list(None),
+        )
+        has_more = len(alerts) > SYNC_MAX_ALERTS
+        token = [synced_at]
+        if has_more:
+            alerts = alerts[:SYNC_MAX_ALERTS]
+            token += [alerts[-1]["created_at"], alerts[-1]["id"]]
+        return compressed_json_response(request, EncodedJson({
+            "token": encode_cursor(token),
+            "full": changed_after is None,
+            "has_more": has_more,
+            "calendar": calendar_entries,
+            "alerts": alerts,
+            "market_prices": market_prices,
+        }))
         
-        return forecasts
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error syncing farmer: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/demand-forecast", response_model=List[DemandForecast])
+async def get_demand_forecast(request: Request):
+    """Get market demand forecast for major crops"""
+    try:
+        # Precomputed by demand_forecast_refresher; the run's version is returned in X-Forecast-Version
+        snapshot = await get_forecast_snapshot()
+        return conditional_json_response(request, snapshot.encoded(), {"X-Forecast-Version": str(snapshot.version)})
         
     except Exception as e:
         logger.error(f"Error getting demand forecast: {str(e)}")
@@ -605,7 +3518,9 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Forecast-Version", "Server-Timing", "ETag"],
 )
+app.add_middleware(MetricsMiddleware)
 
 # Configure logging
 logging.basicConfig(
@@ -614,6 +3529,64 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_indexes():
+    await migrate_iso_datetimes()
+    await migrate_phone_numbers()
+    await migrate_crop_names()
+    # Must exist as a time-series collection before ensure_indexes touches it
+    await ensure_price_history_collection()
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def startup_llm_pool():
+    if LLM_STREAMING and not LLM_API_BASE:
+        raise RuntimeError("LLM_STREAMING=1 requires LLM_API_BASE (an OpenAI-compatible base URL for the key)")
+    llm_pool.start()
+
+@app.on_event("startup")
+async def startup_write_behind():
+    write_behind.start()
+
+@app.on_event("startup")
+async def startup_pest_hash_index():
+    try:
+        await pest_hash_index.load()
+    except Exception as e:
+        logger.error(f"Error loading pest image hashes: {str(e)}")
+
+@app.on_event("startup")
+async def startup_market_prices():
+    try:
+        await load_market_snapshot()
+    except Exception as e:
+        logger.error(f"Error loading market prices: {str(e)}")
+    try:
+        await alert_engine.load()
+        if market_snapshot:
+            await alert_engine.evaluate(market_snapshot)
+    except Exception as e:
+        logger.error(f"Error evaluating market alerts: {str(e)}")
+    start_background_task(market_price_refresher())
+
+@app.on_event("startup")
+async def startup_demand_forecasts():
+    try:
+        await load_demand_forecasts()
+    except Exception as e:
+        logger.error(f"Error loading demand forecasts: {str(e)}")
+    start_background_task(demand_forecast_refresher())
+
+@app.on_event("shutdown")
+async def shutdown_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def shutdown_write_behind():
+    await write_behind.drain()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
\ No newline at end of file
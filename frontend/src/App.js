@@ -380,9 +380,16 @@ const MarketPlace = ({ profile, setView }) => {
 
   useEffect(() => {
     fetchMarketData();
-    if (profile) {
-      fetchAlerts();
-    }
+    if (!profile) return;
+    fetchAlerts();
+
+    // New alerts are pushed by the server; EventSource reconnects and resumes on its own
+    const source = new EventSource(`${API}/market-alerts/${profile.id}/events`);
+    source.addEventListener('alert', (event) => {
+      const alert = JSON.parse(event.data);
+      setAlerts((current) => [alert, ...current.filter((existing) => existing.id !== alert.id)]);
+    });
+    return () => source.close();
   }, [profile]);
 
   const fetchMarketData = async () => {
@@ -505,7 +512,7 @@ const MarketPlace = ({ profile, setView }) => {
                   <div key={index} className={`alert-card ${alert.priority}`}>
                     <div className="alert-header">
                       <span className={`alert-type ${alert.alert_type}`}>
-                        {alert.alert_type === 'price_spike' ? '📈' : '⚡'}
+                        {alert.alert_type === 'price_spike' ? '📈' : alert.alert_type === 'price_drop' ? '📉' : '⚡'}
                       </span>
                       <span className="alert-crop">{alert.crop_name}</span>
                       <span className={`priority-badge ${alert.priority}`}>
@@ -559,6 +566,9 @@ const CropRecommendations = ({ profile, setView }) => {
       const response = await axios.get(`${API}/crop-recommendations/${profile.id}`);
       setRecommendations(response.data.recommendations);
       setAiAnalysis(response.data.ai_analysis);
+      if (response.data.analysis_job_id) {
+        pollAnalysis(response.data.analysis_job_id);
+      }
     } catch (error) {
       console.error('Error fetching recommendations:', error);
     } finally {
@@ -566,6 +576,20 @@ const CropRecommendations = ({ profile, setView }) => {
     }
   };
 
+  // The AI analysis is generated in the background; poll until it is ready
+  const pollAnalysis = async (jobId, attempt = 0) => {
+    try {
+      const response = await axios.get(`${API}/crop-recommendations/jobs/${jobId}`);
+      if (response.data.status === 'done') {
+        setAiAnalysis(response.data.ai_analysis);
+      } else if (response.data.status !== 'failed' && attempt < 30) {
+        setTimeout(() => pollAnalysis(jobId, attempt + 1), 2000);
+      }
+    } catch (error) {
+      console.error('Error fetching AI analysis:', error);
+    }
+  };
+
   const getConfidenceColor = (score) => {
     if (score >= 0.8) return '#4CAF50';
     if (score >= 0.6) return '#FF9800';
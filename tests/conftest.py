@@ -0,0 +1,51 @@
+"""Shared fixtures: backend/server.py imported against an in-process mongomock database.
+
+Needs the backend's requirements (mongomock-motor is pinned there); skipped otherwise.
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+@pytest.fixture(scope="session")
+def server():
+    pytest.importorskip("emergentintegrations")
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import motor.motor_asyncio
+
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "smartcrop_tests")
+    os.environ.setdefault("EMERGENT_LLM_KEY", "test")
+    sys.path.insert(0, str(BACKEND_DIR))
+    # Only server.py's own client is swapped; tests that need a real MongoDB create theirs
+    real_client = motor.motor_asyncio.AsyncIOMotorClient
+    motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+    try:
+        import server
+    finally:
+        motor.motor_asyncio.AsyncIOMotorClient = real_client
+    return server
+
+
+@pytest.fixture
+def db(server):
+    """The server's database, emptied after the test"""
+    yield server.db
+    asyncio.run(server.client.drop_database(server.db.name))
+    server.phone_index_checked = False
+
+
+@pytest.fixture
+def api(server):
+    """Make an httpx client that calls the app in-process; startup hooks are not run"""
+    import httpx
+
+    def client():
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+
+    return client
@@ -0,0 +1,374 @@
+"""Load test and benchmark suite for the FastAPI backend.
+
+Runs the app from backend/server.py in-process (no network hop), backed by a
+local MongoDB or an in-process mongomock stand-in, with LlmChat and LLM
+streaming replaced by fakes of configurable latency. Each endpoint is driven
+at a range of concurrency levels; throughput and p50/p95/p99 latency are
+printed and written as JSON. Pass an earlier run as --baseline to fail on
+p95 regressions.
+
+    python -m tests.load_test --mongo-url mongomock --concurrency 1,8,32 --output bench.json
+    python -m tests.load_test --baseline bench.json --tolerance 0.25
+
+mongomock (mongomock-motor, pinned in backend/requirements.txt) does not
+implement $dateTrunc, so demand-forecast only succeeds against a real MongoDB.
+Not collected by pytest (no test_ prefix); run it explicitly.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import types
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+import numpy as np
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+BACKEND_DIR = ROOT_DIR / "backend"
+
+
+class FakeLlmChat:
+    """Stands in for emergentintegrations' LlmChat; every reply takes `latency` seconds (± jitter)"""
+
+    latency = 0.5
+    jitter = 0.1
+
+    def __init__(self, api_key=None, session_id=None, system_message=None, initial_messages=None):
+        self.session_id = session_id
+
+    def with_model(self, provider, model):
+        return self
+
+    async def send_message(self, message):
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.latency * self.jitter)))
+        return f"Benchmark advice for: {message.text.strip()[:60]}"
+
+
+async def fake_acompletion(**kwargs):
+    """Stands in for litellm.acompletion(stream=True), spreading the latency over 20 chunks"""
+
+    async def chunks():
+        for index in range(20):
+            await asyncio.sleep(FakeLlmChat.latency / 20)
+            delta = types.SimpleNamespace(content=f"token{index} ")
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+    return chunks()
+
+
+def load_server(args):
+    """Import backend/server.py against the chosen database with the LLM faked out"""
+    os.environ["MONGO_URL"] = args.mongo_url if args.mongo_url != "mongomock" else "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = args.db_name
+    os.environ.setdefault("EMERGENT_LLM_KEY", "benchmark")
+    # Token streaming is opt-in; the base URL is never contacted because acompletion is faked
+    os.environ["LLM_STREAMING"] = "1"
+    os.environ.setdefault("LLM_API_BASE", "http://llm.benchmark.invalid/v1")
+    os.environ["MARKET_SIMULATION_SEED"] = str(args.seed)
+    if args.mongo_url == "mongomock":
+        try:
+            import mongomock_motor
+        except ImportError:
+            sys.exit("--mongo-url mongomock needs the mongomock-motor package")
+        import motor.motor_asyncio
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    FakeLlmChat.latency = args.llm_latency
+    server.LlmChat = FakeLlmChat
+    server.litellm.acompletion = fake_acompletion
+    return server
+
+
+async def run_hooks(handlers, label):
+    # Run each hook on its own so one unsupported by the stand-in database does not skip the rest
+    for handler in handlers:
+        try:
+            await handler()
+        except Exception as e:
+            print(f"warning: {label} hook {handler.__name__} failed: {e}", file=sys.stderr)
+
+
+def sample_images(count: int, rng: random.Random) -> list:
+    """Random-noise JPEGs, distinct enough that none is a near-duplicate of another"""
+    from PIL import Image
+
+    pixels = np.random.default_rng(rng.randrange(2**32))
+    images = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.fromarray(pixels.integers(0, 256, (64, 64, 3), dtype=np.uint8)).save(buffer, format="JPEG")
+        images.append(buffer.getvalue())
+    return images
+
+
+async def seed(server, farmers: int, images: int, rng: random.Random) -> dict:
+    """Insert farmers, calendar entries and advice history for the read endpoints to work against"""
+    crops = list(server.PUNJAB_CROPS_DATA)
+    profiles = [
+        server.FarmerProfile(
+            name=f"Farmer {index}",
+            location=rng.choice(server.PUNJAB_MANDIS).split()[0],
+            farm_size=f"{rng.randint(1, 20)} acres",
+            primary_crops=rng.sample(crops, 2),
+            phone=f"9{index:09d}",
+        )
+        for index in range(farmers)
+    ]
+    await server.db.farmer_profiles.insert_many([profile.dict() for profile in profiles])
+
+    plans = [(profile.id, crop) for profile in profiles for crop in profile.primary_crops]
+    calendars = server.calendar_planner.plan([crop for _, crop in plans], price_ratios=server.current_price_ratios())
+    entries = [
+        server.build_calendar_entry(farmer_id, crop, calendar).dict()
+        for (farmer_id, crop), calendar in zip(plans, calendars)
+    ]
+    await server.db.crop_calendar.insert_many(entries)
+
+    now = datetime.now(timezone.utc)
+    advice = [
+        server.CropAdviceResponse(
+            query=f"history question {index}", advice="...", timestamp=now - timedelta(minutes=index)
+        ).dict()
+        for index in range(1000)
+    ]
+    await server.db.crop_advice.insert_many(advice)
+
+    return {
+        "farmer_ids": [profile.id for profile in profiles],
+        "images": sample_images(images, rng),
+        # Numbers requests across the whole run so "uncached" scenarios never repeat themselves
+        "sequence": itertools.count(),
+        # Taken after seeding, so a delta sync sees only what changes during the run
+        "sync_token": server.encode_cursor([datetime.now(timezone.utc)]),
+    }
+
+
+PEST_BATCH_SIZE = 8  # images per pest-batch request
+IMPORT_ROWS = 100  # farmers per farmer-import request
+
+
+def next_image(ctx: dict) -> bytes:
+    return ctx["images"][next(ctx["sequence"]) % len(ctx["images"])]
+
+
+def next_image_base64(ctx: dict) -> str:
+    return base64.b64encode(next_image(ctx)).decode()
+
+
+def farmer_id(i: int, ctx: dict) -> str:
+    return ctx["farmer_ids"][i % len(ctx["farmer_ids"])]
+
+
+def import_csv(ctx: dict) -> bytes:
+    """IMPORT_ROWS new farmers with phone numbers unique across the run"""
+    rows = ["name,location,farm_size,primary_crops,phone"]
+    for _ in range(IMPORT_ROWS):
+        number = next(ctx["sequence"])
+        rows.append(f'"Imported {number}",Ludhiana,3 acres,Wheat;Rice,7{number:09d}')
+    return "\n".join(rows).encode()
+
+
+# name -> function(i, ctx) returning (method, path, keyword arguments for httpx's request())
+SCENARIOS = {
+    "market-prices": lambda i, ctx: ("GET", "/api/market-prices", {}),
+    "demand-forecast": lambda i, ctx: ("GET", "/api/demand-forecast", {}),
+    "farmer-profiles": lambda i, ctx: ("GET", "/api/farmer-profiles", {}),
+    "advice-history": lambda i, ctx: ("GET", "/api/advice-history", {}),
+    "crop-calendar": lambda i, ctx: ("GET", f"/api/crop-calendar/{farmer_id(i, ctx)}", {}),
+    "market-alerts": lambda i, ctx: ("GET", f"/api/market-alerts/{farmer_id(i, ctx)}", {}),
+    "crop-recommendations": lambda i, ctx: ("GET", f"/api/crop-recommendations/{farmer_id(i, ctx)}", {}),
+    "crop-advice-cached": lambda i, ctx: ("POST", "/api/crop-advice", {"json": {"query": "When should I sow wheat?", "crop_type": "Wheat", "location": "Ludhiana"}}),
+    "crop-advice-uncached": lambda i, ctx: ("POST", "/api/crop-advice", {"json": {"query": f"Question {ctx['run']}-{next(ctx['sequence'])} about rice", "crop_type": "Rice"}}),
+    # Timed until the last event, so this measures the whole streamed answer
+    "crop-advice-stream": lambda i, ctx: ("POST", "/api/crop-advice/stream", {"json": {"query": f"Streamed question {ctx['run']}-{next(ctx['sequence'])} about maize", "crop_type": "Corn"}}),
+    "pest-detection": lambda i, ctx: ("POST", "/api/pest-detection", {"json": {"image_base64": next_image_base64(ctx), "crop_type": "Cotton"}}),
+    "pest-upload": lambda i, ctx: ("POST", "/api/pest-detection/upload", {"files": {"file": ("leaf.jpg", next_image(ctx), "image/jpeg")}, "data": {"crop_type": "Cotton"}}),
+    "pest-batch": lambda i, ctx: ("POST", "/api/pest-detection/batch", {"json": {"items": [{"image_base64": next_image_base64(ctx), "crop_type": "Rice"} for _ in range(PEST_BATCH_SIZE)]}}),
+    "farmer-import": lambda i, ctx: ("POST", "/api/farmer-profiles/import", {"content": import_csv(ctx), "headers": {"Content-Type": "text/csv"}}),
+    "export-advice": lambda i, ctx: ("GET", "/api/export/crop-advice", {}),
+    "sync-full": lambda i, ctx: ("GET", f"/api/sync/{farmer_id(i, ctx)}", {}),
+    "sync-delta": lambda i, ctx: ("GET", f"/api/sync/{farmer_id(i, ctx)}", {"params": {"since": ctx["sync_token"]}}),
+}
+
+# Distinct photos each scenario sends per request, so none is served from the near-duplicate index
+IMAGES_PER_REQUEST = {"pest-detection": 1, "pest-upload": 1, "pest-batch": PEST_BATCH_SIZE}
+
+
+def summarize(latencies, errors: int, wall: float) -> dict:
+    values = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) if len(values) else (0.0, 0.0, 0.0)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "latency_ms": {
+            "mean": round(float(values.mean()), 2) if len(values) else 0.0,
+            "p50": round(float(p50), 2),
+            "p95": round(float(p95), 2),
+            "p99": round(float(p99), 2),
+            "max": round(float(values.max()), 2) if len(values) else 0.0,
+        },
+    }
+
+
+async def run_level(client, scenario, ctx: dict, concurrency: int, total: int) -> dict:
+    """Issue `total` requests from `concurrency` workers and summarise their latencies"""
+    latencies = []
+    errors = 0
+    counter = itertools.count()
+
+    async def worker():
+        nonlocal errors
+        while (index := next(counter)) < total:
+            method, path, kwargs = scenario(index, ctx)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                # Streams report failures in-band after a 200
+                failed = response.status_code >= 400 or (
+                    response.headers.get("content-type", "").startswith("text/event-stream")
+                    and b"event: error" in response.content
+                )
+            except Exception:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> list:
+    """Return a line per endpoint/concurrency whose p95 grew by more than `tolerance` over the baseline"""
+    baseline = {
+        (row["endpoint"], row["concurrency"]): row
+        for row in json.loads(Path(baseline_path).read_text())["results"]
+    }
+    regressions = []
+    for row in results:
+        before = baseline.get((row["endpoint"], row["concurrency"]))
+        if not before or not before["latency_ms"]["p95"]:
+            continue
+        change = row["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1
+        if change > tolerance:
+            regressions.append(
+                f"{row['endpoint']} @ c={row['concurrency']}: p95 "
+                f"{before['latency_ms']['p95']} -> {row['latency_ms']['p95']} ms ({change:+.0%})"
+            )
+    return regressions
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return "unknown"
+
+
+async def main(args) -> int:
+    import httpx
+
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+    server = load_server(args)
+    endpoints = args.endpoints.split(",") if args.endpoints else list(SCENARIOS)
+    unknown = [name for name in endpoints if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"unknown endpoints: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    await server.client.drop_database(args.db_name)
+    await run_hooks(server.app.router.on_startup, "startup")
+    if args.mongo_url == "mongomock":
+        # mongomock cannot create the time-series collection, which stops startup_indexes
+        # before the indexes; farmer-import is refused without the unique phone index
+        await run_hooks([server.ensure_indexes], "startup")
+    requests_per_endpoint = args.warmup + args.requests * len(levels)
+    images = sum(IMAGES_PER_REQUEST.get(name, 0) for name in endpoints) * requests_per_endpoint
+    ctx = await seed(server, args.farmers, images, rng)
+    ctx["run"] = int(time.time())
+
+    results = []
+    transport = httpx.ASGITransport(app=server.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            for name in endpoints:
+                scenario = SCENARIOS[name]
+                await run_level(client, scenario, ctx, min(levels), args.warmup)
+                for concurrency in levels:
+                    row = {"endpoint": name, "concurrency": concurrency}
+                    row.update(await run_level(client, scenario, ctx, concurrency, args.requests))
+                    results.append(row)
+                    latency = row["latency_ms"]
+                    print(
+                        f"{name:<22} c={concurrency:<4} {row['throughput_rps']:>9.1f} req/s  "
+                        f"p50 {latency['p50']:>8.2f}  p95 {latency['p95']:>8.2f}  p99 {latency['p99']:>8.2f} ms"
+                        + (f"  errors {row['errors']}" if row["errors"] else "")
+                    )
+    finally:
+        if not args.keep_db:
+            await server.client.drop_database(args.db_name)
+        await run_hooks(server.app.router.on_shutdown, "shutdown")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "mongo": "mongomock" if args.mongo_url == "mongomock" else "mongodb",
+            "llm_latency_seconds": args.llm_latency,
+            "requests_per_level": args.requests,
+            "farmers": args.farmers,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"wrote {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"),
+                        help="MongoDB to run against, or 'mongomock' for the in-process stand-in")
+    parser.add_argument("--db-name", default="smartcrop_benchmark", help="database to create, seed and drop")
+    parser.add_argument("--keep-db", action="store_true", help="leave the seeded database in place")
+    parser.add_argument("--endpoints", help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint and level")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests before each endpoint")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per fake LLM reply")
+    parser.add_argument("--farmers", type=int, default=200, help="farmer profiles to seed")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--baseline", help="earlier JSON results to compare p95 latency against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative p95 increase")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,141 @@
+"""Streaming farmer import: CSV record grouping, per-row rejection and duplicate detection."""
+import asyncio
+import json
+
+import pytest
+
+HEADER = "name,location,farm_size,primary_crops,phone\n"
+
+
+async def collect(generator):
+    return [item async for item in generator]
+
+
+async def numbered(lines):
+    for number, line in enumerate(lines, 1):
+        yield number, line
+
+
+def csv_records(server, lines):
+    return asyncio.run(collect(server.iter_csv_records(numbered(lines))))
+
+
+@pytest.mark.parametrize("line, in_quotes, still_open", [
+    ('a,b,c', False, False),
+    ('"a,b",c', False, False),
+    ('a,"b', False, True),
+    ('still inside",c', True, False),
+    ('escaped "" quote', True, True),
+    ('X,Ludhiana,5" plot,Wheat', False, False),
+    ('"He said ""hi""",b', False, False),
+])
+def test_csv_quote_open(server, line, in_quotes, still_open):
+    assert server.csv_quote_open(line, in_quotes) is still_open
+
+
+def test_csv_records_join_lines_inside_quoted_fields(server):
+    records = csv_records(server, ['a,"first', 'second",b', 'c,d'])
+    assert records == [(1, 'a,"first\nsecond",b'), (3, "c,d")]
+
+
+def test_csv_records_keep_a_stray_quote_to_its_own_line(server):
+    records = csv_records(server, ['X,Ludhiana,5" plot,Wheat,9000000010', 'Y,Moga,2,Rice,9000000011'])
+    assert [row for row, _ in records] == [1, 2]
+
+
+def test_csv_records_yield_an_unterminated_field_at_the_end(server):
+    assert csv_records(server, ['a,"open', 'more']) == [(1, 'a,"open\nmore')]
+
+
+def test_csv_records_cut_off_a_runaway_quoted_field(server):
+    line = "x" * 1000
+    lines = ['a,"open'] + [line] * (server.FARMER_IMPORT_MAX_LINE_BYTES // len(line) + 1) + ["b,c"]
+    records = csv_records(server, lines)
+    assert records[0] == (1, None)
+    assert records[-1] == (len(lines), "b,c")
+
+
+def test_canonical_phone(server):
+    assert server.canonical_phone("+91 98765-43210") == "9876543210"
+    assert server.canonical_phone("098765 43210") == "9876543210"
+    assert server.canonical_phone("n/a") is None
+
+
+def import_body(server, api, body, content_type="text/csv", chunk_size=None):
+    async def chunks():
+        for start in range(0, len(body), chunk_size):
+            yield body[start:start + chunk_size]
+
+    async def scenario():
+        await server.ensure_indexes()
+        async with api() as client:
+            response = await client.post(
+                "/api/farmer-profiles/import",
+                content=chunks() if chunk_size else body,
+                headers={"Content-Type": content_type},
+            )
+            return response.status_code, response.json()
+
+    return asyncio.run(scenario())
+
+
+def test_import_streams_quoted_newlines_and_unicode(server, db, api):
+    rows = "".join(f'"Jasprit ünïcødé {i}","Mo\nga",2 acres,Wheat;Rice,90000{i:05d}\r\n' for i in range(50))
+    status, summary = import_body(server, api, ("﻿" + HEADER + rows).encode(), chunk_size=7)
+
+    assert status == 200
+    assert summary == {"accepted": 50, "duplicates": 0, "rejected": 0, "errors": []}
+    farmer = asyncio.run(db.farmer_profiles.find_one({"phone": "9000000007"}))
+    assert (farmer["name"], farmer["location"], farmer["primary_crops"]) == ("Jasprit ünïcødé 7", "Mo\nga", ["Wheat", "Rice"])
+
+
+def test_import_rejects_malformed_rows_and_keeps_the_rest(server, db, api):
+    body = (
+        HEADER
+        + 'X,Ludhiana,5" plot,Wheat,9000000010\n'
+        + '"Bad"x,Moga,2,Wheat,9000000011\n'
+        + ",Moga,2,Wheat,9000000012\n"
+        + "".join(f"F{i},Ludhiana,2 acres,Wheat,91000{i:05d}\n" for i in range(20))
+        + '"Open,Moga,2,Wheat,9000000013\n'
+    )
+    status, summary = import_body(server, api, body.encode())
+
+    assert status == 200
+    assert summary["accepted"] == 21
+    assert [error["row"] for error in summary["errors"]] == [3, 4, 25]
+
+
+def test_import_counts_duplicate_phones(server, db, api):
+    rows = "A,Moga,2,Wheat,+91 90000 00001\nB,Moga,2,Wheat,09000000001\nC,Moga,2,Wheat,9000000002\n"
+    status, summary = import_body(server, api, (HEADER + rows).encode())
+
+    assert status == 200
+    assert (summary["accepted"], summary["duplicates"]) == (2, 1)
+
+
+def test_import_ndjson_accepts_numeric_phones(server, db, api):
+    records = [
+        {"name": "N", "location": "Moga", "farm_size": "2", "primary_crops": ["wheat "], "phone": 9200000001},
+        ["not", "an", "object"],
+    ]
+    body = "\n".join(json.dumps(record) for record in records).encode()
+    status, summary = import_body(server, api, body, content_type="application/x-ndjson")
+
+    assert status == 200
+    assert (summary["accepted"], summary["rejected"]) == (1, 1)
+    farmer = asyncio.run(db.farmer_profiles.find_one({"phone": "9200000001"}))
+    assert farmer["primary_crops"] == ["Wheat"]
+
+
+def test_import_rejects_overlong_lines(server, db, api):
+    overlong = "A," + "x" * server.FARMER_IMPORT_MAX_LINE_BYTES + ",2,Wheat,9000000001\n"
+    status, summary = import_body(server, api, (HEADER + overlong + "B,Moga,2,Wheat,9000000002\n").encode(), chunk_size=4096)
+
+    assert status == 200
+    assert summary["accepted"] == 1
+    assert summary["errors"][0]["row"] == 2
+
+
+def test_import_refuses_unknown_formats(server, db, api):
+    status, _ = import_body(server, api, b"<farmers/>", content_type="application/xml")
+    assert status == 415
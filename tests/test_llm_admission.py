@@ -0,0 +1,263 @@
+"""LLM admission control: circuit breaker, single-flight coalescing, the client pool and the advice cache key."""
+import asyncio
+import types
+from contextlib import aclosing
+
+import pytest
+
+
+class FakeChat:
+    """Stands in for an LlmChat; replies after `delay` seconds, or raises `error`"""
+
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+
+    async def send_message(self, message):
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return f"advice for {message.text}"
+
+
+def make_pool(server, size=1, max_queue=0, timeout=1.0, breaker=None, stream_timeout=None):
+    breaker = breaker or server.CircuitBreaker(0.5, 10.0, 60.0)
+    return server.LlmClientPool(size, 10, 5, max_queue, timeout, breaker, stream_timeout)
+
+
+def use_chat(monkeypatch, server, chat):
+    monkeypatch.setattr(server, "get_llm_chat", lambda session_id: chat)
+
+
+def test_breaker_opens_once_enough_calls_fail(server):
+    breaker = server.CircuitBreaker(0.5, 10.0, 60.0)
+    for _ in range(breaker.MIN_CALLS):
+        breaker.record(breaker.allow(), 0.1, ok=False)
+    assert breaker.state == "open"
+    assert breaker.trips == 1
+    assert breaker.allow() is None
+
+
+def test_breaker_counts_slow_successes_as_failures(server):
+    breaker = server.CircuitBreaker(0.5, 1.0, 60.0)
+    for _ in range(breaker.MIN_CALLS):
+        breaker.record(breaker.allow(), 2.0, ok=True)
+    assert breaker.state == "open"
+
+
+def test_breaker_ignores_outcomes_from_an_earlier_generation(server):
+    breaker = server.CircuitBreaker(0.5, 10.0, 0.0)
+    stale = breaker.allow()
+    for _ in range(breaker.MIN_CALLS):
+        breaker.record(breaker.allow(), 0.1, ok=False)
+    assert breaker.state == "open"
+
+    # A success admitted before the breaker opened must not close it
+    breaker.record(stale, 0.1, ok=True)
+    assert breaker.state == "open"
+
+    probe = breaker.allow()
+    assert breaker.state == "half_open"
+    breaker.record(probe, 0.1, ok=True)
+    assert breaker.state == "closed"
+
+    # Nor may a failure from before the trip count against the recovered provider
+    breaker.record(stale, 0.1, ok=False)
+    assert len(breaker._outcomes) == 0
+
+
+def test_breaker_lets_one_probe_through_and_frees_it_when_abandoned(server):
+    breaker = server.CircuitBreaker(0.5, 10.0, 0.0)
+    for _ in range(breaker.MIN_CALLS):
+        breaker.record(breaker.allow(), 0.1, ok=False)
+
+    probe = breaker.allow()
+    assert probe is not None
+    assert breaker.allow() is None
+    breaker.abandon(probe)
+    assert breaker.allow() == probe
+
+
+def test_single_flight_shares_one_call(server):
+    flight = server.SingleFlight()
+    started = []
+
+    async def factory():
+        started.append(1)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def scenario():
+        return await asyncio.gather(*(flight.do("key", factory) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["answer"] * 5
+    assert len(started) == 1
+    assert (flight.calls, flight.coalesced) == (1, 4)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_single_flight_survives_a_cancelled_waiter(server):
+    flight = server.SingleFlight()
+    finished = []
+
+    async def factory():
+        await asyncio.sleep(0.05)
+        finished.append(1)
+        return "answer"
+
+    async def scenario():
+        leaving = asyncio.ensure_future(flight.do("key", factory))
+        staying = asyncio.ensure_future(flight.do("key", factory))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leaving
+        return await staying
+
+    assert asyncio.run(scenario()) == "answer"
+    assert finished == [1]
+
+
+def test_single_flight_forgets_failed_calls(server):
+    flight = server.SingleFlight()
+    attempts = []
+
+    async def factory():
+        attempts.append(1)
+        raise RuntimeError("provider down")
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await flight.do("key", factory)
+
+    asyncio.run(scenario())
+    assert len(attempts) == 2
+
+
+def test_pool_sheds_calls_beyond_the_queue(server, monkeypatch):
+    use_chat(monkeypatch, server, FakeChat(delay=0.05))
+    pool = make_pool(server, size=1, max_queue=1)
+
+    async def scenario():
+        return await asyncio.gather(*(pool.send("prompt") for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert sum(isinstance(result, server.LlmUnavailable) for result in results) == 1
+    assert pool.shed["queue_full"] == 1
+    assert (pool.in_flight, pool.waiting) == (0, 0)
+
+
+def test_pool_turns_a_missed_deadline_into_unavailable(server, monkeypatch):
+    use_chat(monkeypatch, server, FakeChat(delay=1.0))
+    pool = make_pool(server, timeout=0.05)
+
+    with pytest.raises(server.LlmUnavailable):
+        asyncio.run(pool.send("prompt"))
+    assert pool.shed["deadline"] == 1
+    assert (pool.in_flight, pool.waiting) == (0, 0)
+
+
+def test_pool_turns_provider_errors_into_unavailable(server, monkeypatch):
+    use_chat(monkeypatch, server, FakeChat(error=RuntimeError("502 from provider")))
+    pool = make_pool(server)
+
+    async def scenario():
+        for _ in range(pool.breaker.MIN_CALLS):
+            with pytest.raises(server.LlmUnavailable):
+                await pool.send("prompt")
+        # The breaker has now tripped, so the next call is shed without reaching the provider
+        with pytest.raises(server.LlmUnavailable, match="circuit breaker"):
+            await pool.send("prompt")
+
+    asyncio.run(scenario())
+    assert pool.breaker.state == "open"
+    assert pool.shed["circuit_open"] == 1
+
+
+def test_pool_serializes_turns_of_one_session_without_holding_slots(server, monkeypatch):
+    use_chat(monkeypatch, server, FakeChat(delay=0.05))
+    pool = make_pool(server, size=2, max_queue=10)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        turns = [asyncio.ensure_future(pool.send("turn", "farmer:1")) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        started = loop.time()
+        await pool.send("stateless")
+        waited = loop.time() - started
+        await asyncio.gather(*turns)
+        return waited
+
+    # The queued turns wait on their session lock, leaving the second slot to the stateless call
+    assert asyncio.run(scenario()) < 0.15
+
+
+def fake_stream(chunks, delay=0.0):
+    async def open_stream(prompt):
+        async def stream():
+            for text in chunks:
+                await asyncio.sleep(delay)
+                delta = types.SimpleNamespace(content=text)
+                yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+        return stream()
+    return open_stream
+
+
+def test_stream_yields_chunks_and_releases_the_slot(server, monkeypatch):
+    monkeypatch.setattr(server, "open_llm_stream", fake_stream(["a", "b", "c"]))
+    pool = make_pool(server)
+
+    async def scenario():
+        return [chunk async for chunk in pool.stream("prompt")]
+
+    assert asyncio.run(scenario()) == ["a", "b", "c"]
+    assert (pool.in_flight, pool.waiting) == (0, 0)
+
+
+def test_stream_releases_the_slot_when_the_client_leaves(server, monkeypatch):
+    monkeypatch.setattr(server, "open_llm_stream", fake_stream(["a"] * 100, delay=0.001))
+    pool = make_pool(server)
+
+    async def scenario():
+        async with aclosing(pool.stream("prompt")) as stream:
+            async for _ in stream:
+                break
+        return pool.in_flight, pool.waiting
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def test_stream_that_never_starts_is_shed(server, monkeypatch):
+    monkeypatch.setattr(server, "open_llm_stream", fake_stream(["late"], delay=1.0))
+    pool = make_pool(server, timeout=0.05, stream_timeout=5.0)
+
+    async def scenario():
+        return [chunk async for chunk in pool.stream("prompt")]
+
+    with pytest.raises(server.LlmUnavailable):
+        asyncio.run(scenario())
+    assert pool.shed["deadline"] == 1
+    assert pool.in_flight == 0
+
+
+def test_advice_cache_key_ignores_case_spacing_and_spelling(server):
+    def key(**fields):
+        return server.advice_cache_key(server.CropAdviceRequest(**fields))
+
+    canonical = key(query="When should I sow wheat?", crop_type="Wheat", location="Ludhiana")
+    assert key(query="  when should I  SOW wheat? ", crop_type=" wheat", location="ludhiana, punjab") == canonical
+    assert key(query="When should I sow wheat?", crop_type="Wheat", location="Ludhiana", language="English") == canonical
+    assert key(query="When should I sow wheat?", crop_type="Wheat", location="Ludhiana", language="Punjabi") != canonical
+    assert key(query="When should I sow rice?", crop_type="Wheat", location="Ludhiana") != canonical
+
+
+def test_advice_cache_survives_a_restart(server, db):
+    async def scenario():
+        await server.AdviceCache(db.advice_cache, 10, 60).set("key", "sow in November")
+        restarted = server.AdviceCache(db.advice_cache, 10, 60)
+        return await restarted.get("key"), await restarted.get("other"), restarted.stats()
+
+    advice, missing, stats = asyncio.run(scenario())
+    assert (advice, missing) == ("sow in November", None)
+    assert (stats["persistent_hits"], stats["misses"]) == (1, 1)
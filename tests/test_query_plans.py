@@ -0,0 +1,41 @@
+"""Fails when a query the backend issues would scan a whole collection.
+
+Creates the app's indexes in a throwaway database on MONGO_URL (default
+mongodb://localhost:27017), explains every query in server.endpoint_queries()
+and drops the database again. Skipped when no MongoDB is reachable.
+"""
+import asyncio
+import os
+import uuid
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+
+
+@pytest.fixture(scope="module")
+def mongo_server(server):
+    try:
+        pymongo.MongoClient(MONGO_URL, serverSelectionTimeoutMS=1000).admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip(f"no MongoDB reachable at {MONGO_URL}")
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    # The plan checks only go through server.db, so point it at a real database for this module
+    db_name = f"query_plans_{uuid.uuid4().hex[:12]}"
+    mongomock_db = server.db
+    server.db = AsyncIOMotorClient(MONGO_URL)[db_name]
+    yield server
+    server.db = mongomock_db
+    pymongo.MongoClient(MONGO_URL).drop_database(db_name)
+
+
+def test_every_query_uses_an_index(mongo_server):
+    async def explain():
+        await mongo_server.ensure_price_history_collection()
+        await mongo_server.ensure_indexes()
+        return await mongo_server.find_collection_scans()
+
+    assert asyncio.run(explain()) == []
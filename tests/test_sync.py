@@ -0,0 +1,150 @@
+"""Keyset cursors and the delta-sync endpoint: paging, tokens and stable row ids."""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+FARMER = {"name": "Gurpreet", "location": "Ludhiana", "farm_size": "4 acres", "primary_crops": ["Wheat"], "phone": "9876543210"}
+
+
+def make_alert(server, farmer_id, created_at):
+    return server.MarketAlert(
+        farmer_id=farmer_id, crop_name="Wheat", alert_type="price_spike", message="Wheat is up",
+        priority="high", mandi_name="Ludhiana Mandi", price_offered=2400.0,
+        valid_until=created_at + timedelta(days=2), created_at=created_at,
+    ).dict()
+
+
+def test_cursor_round_trip(server):
+    when = datetime(2025, 3, 1, 6, 30, tzinfo=timezone.utc)
+    assert server.decode_cursor(server.encode_cursor([when, "id-1", 3])) == [when, "id-1", 3]
+
+
+# Not base64, and base64 of a JSON object rather than a list
+@pytest.mark.parametrize("token", ["not base64!", "eyJhIjogMX0"])
+def test_invalid_cursor_is_a_400(server, token):
+    with pytest.raises(server.HTTPException) as raised:
+        server.decode_cursor(token)
+    assert raised.value.status_code == 400
+
+
+def test_keyset_query_continues_after_ties(server):
+    sort = [("created_at", server.ASCENDING), ("id", server.ASCENDING)]
+    when = datetime(2025, 3, 1, tzinfo=timezone.utc)
+    assert server.keyset_query({"farmer_id": "f"}, sort, [when, "b"]) == {"$and": [
+        {"farmer_id": "f"},
+        {"$or": [{"created_at": {"$gt": when}}, {"created_at": when, "id": {"$gt": "b"}}]},
+    ]}
+    assert server.keyset_query({}, sort, None) == {}
+    with pytest.raises(server.HTTPException):
+        server.keyset_query({}, sort, [when])
+
+
+def test_fetch_page_visits_every_row_once(server, db):
+    when = datetime(2025, 3, 1, tzinfo=timezone.utc)
+    # Every third row shares a timestamp, so paging has to break ties on id
+    docs = [{"id": f"{index:04d}", "created_at": when - timedelta(seconds=index // 3)} for index in range(95)]
+
+    async def scenario():
+        await db.pages.insert_many(docs)
+        seen, cursor = [], None
+        while True:
+            after = server.decode_cursor(cursor) if cursor else None
+            page, cursor = await server.fetch_page(db.pages, {}, server.FARMER_PROFILES_SORT, 10, after, {"_id": 0})
+            seen.extend(page)
+            if cursor is None:
+                return seen
+
+    seen = asyncio.run(scenario())
+    assert len(seen) == 95
+    assert len({doc["id"] for doc in seen}) == 95
+    keys = [(doc["created_at"], doc["id"]) for doc in seen]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_sync_token_validation(server):
+    when = datetime(2025, 3, 1, tzinfo=timezone.utc)
+    assert server.decode_sync_token(server.encode_cursor([when])) == (when, None)
+    assert server.decode_sync_token(server.encode_cursor([when, when, "a"])) == (when, [when, "a"])
+    for values in ([when, 5, "a"], [when, when], ["yesterday"]):
+        with pytest.raises(server.HTTPException):
+            server.decode_sync_token(server.encode_cursor(values))
+
+
+def sync_pages(api, farmer_id, token=None):
+    """Follow has_more from token, returning every page"""
+    async def scenario(token):
+        pages = []
+        async with api() as client:
+            while True:
+                response = await client.get(f"/api/sync/{farmer_id}", params={"since": token} if token else None)
+                assert response.status_code == 200
+                page = response.json()
+                pages.append(page)
+                token = page["token"]
+                if not page["has_more"]:
+                    return pages
+
+    return asyncio.run(scenario(token))
+
+
+def create_farmer(api):
+    async def scenario():
+        async with api() as client:
+            return (await client.post("/api/farmer-profile", json=FARMER)).json()["id"]
+
+    return asyncio.run(scenario())
+
+
+def test_sync_pages_through_alerts_without_gaps(server, db, api):
+    farmer_id = create_farmer(api)
+    now = datetime.now(timezone.utc)
+    total = server.SYNC_MAX_ALERTS * 2 + 50
+    # Old enough to fall outside the overlap window, with plenty of timestamp ties
+    alerts = [make_alert(server, farmer_id, now - timedelta(hours=1, seconds=index // 4)) for index in range(total)]
+    asyncio.run(db.market_alerts.insert_many(alerts))
+
+    pages = sync_pages(api, farmer_id)
+    assert len(pages) == 3
+    assert pages[0]["full"] is True
+    ids = [alert["id"] for page in pages for alert in page["alerts"]]
+    assert len(ids) == len(set(ids)) == total
+
+    # A later sync from the final token returns only what arrived since
+    asyncio.run(db.market_alerts.insert_one(make_alert(server, farmer_id, datetime.now(timezone.utc))))
+    delta = sync_pages(api, farmer_id, pages[-1]["token"])
+    assert [page["full"] for page in delta] == [False]
+    assert len(delta[0]["alerts"]) == 1
+
+
+def test_sync_rejects_bad_tokens_and_unknown_farmers(server, db, api):
+    farmer_id = create_farmer(api)
+
+    async def scenario():
+        async with api() as client:
+            bad_token = await client.get(f"/api/sync/{farmer_id}", params={"since": "garbage"})
+            unknown = await client.get("/api/sync/no-such-farmer")
+            return bad_token.status_code, unknown.status_code
+
+    assert asyncio.run(scenario()) == (400, 404)
+
+
+def test_market_price_ids_stay_stable_across_refreshes(server, db, api):
+    farmer_id = create_farmer(api)
+
+    async def scenario():
+        await server.load_market_snapshot()
+        await server.refresh_market_prices()
+        async with api() as client:
+            before = (await client.get(f"/api/sync/{farmer_id}")).json()["market_prices"]
+            await server.refresh_market_prices()
+            after = (await client.get(f"/api/sync/{farmer_id}")).json()["market_prices"]
+            published = (await client.get("/api/market-prices")).json()
+        return before, after, published
+
+    before, after, published = asyncio.run(scenario())
+
+    def ids(rows):
+        return {(row["crop_name"], row["mandi_name"]): row["id"] for row in rows}
+
+    assert ids(before) and ids(before) == ids(after) == ids(published)